@@ -0,0 +1,100 @@
+import asyncio
+import subprocess
+import sys
+import time
+
+from main import SERVER_HOST, get_option, open_connection, request
+
+CLIENTS = 32
+QUERIES_PER_CLIENT = 50
+ROWS = 1000
+
+QUERIES = [
+    "select Age > 30 Load",
+    'project Name,Department (select Department == "Finance" Load)',
+    "Load join LoadDepartments",
+]
+
+
+def load_relations():
+    yield "Load {"
+    yield "Name, Age, Department"
+    for i in range(ROWS):
+        department = ["Finance", "H.R.", "Media"][i % 3]
+        yield f'"person{i}", {20 + i % 50}, "{department}"'
+    yield "}"
+    yield "LoadDepartments {"
+    yield "Department, Manager"
+    yield '"Finance", "John"'
+    yield '"H.R.", "Alex"'
+    yield '"Media", "William"'
+    yield "}"
+
+
+async def wait_for_server(host, port):
+    for _ in range(100):
+        try:
+            return await open_connection(host, port)
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise ConnectionError(f"Could not connect to {host}:{port}")
+
+
+async def run_client(host, port, latencies):
+    reader, writer = await open_connection(host, port)
+    for i in range(QUERIES_PER_CLIENT):
+        start = time.perf_counter()
+        lines = await request(reader, writer, QUERIES[i % len(QUERIES)])
+        latencies.append(time.perf_counter() - start)
+        if lines[0].startswith("Could not"):
+            raise RuntimeError(lines[0])
+    writer.close()
+
+
+async def run_load_test(host, port):
+    reader, writer = await wait_for_server(host, port)
+    for line in load_relations():
+        await request(reader, writer, line)
+    writer.close()
+
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(run_client(host, port, latencies) for _ in range(CLIENTS)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"Clients: {CLIENTS}, queries: {len(latencies)}, rows: {ROWS}")
+    print(f"Queries per second: {len(latencies) / elapsed:.1f}")
+    print(f"p50 latency: {p50 * 1000:.2f} ms")
+    print(f"p99 latency: {p99 * 1000:.2f} ms")
+
+
+def main():
+    host = get_option(["--host"], SERVER_HOST)
+    port = int(get_option(["--port"], 7879))
+    server = None
+    if "--external" not in sys.argv:
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                "main.py",
+                "--server",
+                "--host",
+                host,
+                "--port",
+                str(port),
+            ],
+            stdout=subprocess.DEVNULL,
+        )
+    try:
+        asyncio.run(run_load_test(host, port))
+    finally:
+        if server != None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,14 @@
+import asyncio
+import heapq
+import itertools
+import math
+import operator
+import pickle
 import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 COMPARISON_OPERATORS = [
     ">",
@@ -15,6 +25,8 @@ RELATIONAL_OPERATORS = [
     "intersect",
     "minus",
     "join",
+    "semi_join",
+    "anti_join",
     "theta_join",
     "left_join",
     "right_join",
@@ -46,18 +58,41 @@ class BinaryExpression:
         self.left = left
         self.right = right
         self.operator = operator
+        # NOTE: Set by check_types(), only NULL checks are needed after type checking
+        self.type_checked = False
+        self.relation_type = None
+        self.nullable = True
+        # NOTE: Filters only apply to relations, conditions evaluated for every tuple
+        # of a select or join skip them
+        self.relational = (
+            isinstance(operator, tuple) or operator in RELATIONAL_OPERATORS
+        )
+        # NOTE: Tuples dropped early by the Bloom filter built for this join
+        self.rows_eliminated = 0
 
     def __repr__(self):
         return f"BinaryExpression{{{self.left} {self.operator} {self.right}}}"
 
-    def evaluate(self, assignments):
-        left_value = self.left.evaluate(assignments)
-        right_value = self.right.evaluate(assignments)
-        if left_value == "NULL" or right_value == "NULL":
+    def evaluate(self, assignments, filters=()):
+        if self.relational:
+            if BLOOM_FILTERS and self.type_checked and is_hash_join(self):
+                return self.evaluate_hash_join(assignments, filters)
+            left_filters, right_filters = passed_filters(self.operator, filters)
+            left_value = evaluate_operand(self.left, assignments, left_filters)
+            right_value = evaluate_operand(self.right, assignments, right_filters)
+        else:
+            left_value = self.left.evaluate(assignments)
+            right_value = self.right.evaluate(assignments)
+        if not self.type_checked:
+            if left_value == "NULL" or right_value == "NULL":
+                raise EvaluationException(f"Cannot use NULL in a binary expression")
+            if type(left_value) != type(right_value):
+                raise EvaluationException(
+                    f"Type mismatch for operands of {self.operator}"
+                )
+            type_check(self.operator, left_value)
+        elif self.nullable and (left_value == "NULL" or right_value == "NULL"):
             raise EvaluationException(f"Cannot use NULL in a binary expression")
-        if type(left_value) != type(right_value):
-            raise EvaluationException(f"Type mismatch for operands of {self.operator}")
-        type_check(self.operator, left_value)
         match self.operator:
             case ">":
                 return left_value > right_value
@@ -83,6 +118,10 @@ class BinaryExpression:
                 return subtract(left_value, right_value)
             case "join":
                 return natural_join(left_value, right_value)
+            case "semi_join":
+                return semi_join(left_value, right_value)
+            case "anti_join":
+                return semi_join(left_value, right_value, anti=True)
             case ("theta_join", condition):
                 return theta_join(left_value, right_value, condition)
             case ("left_join", condition):
@@ -98,17 +137,98 @@ class BinaryExpression:
                     right_outer=True,
                 )
 
+    # NOTE: Builds the hash table on the left operand first, so that a Bloom filter
+    # of its keys can drop tuples while the right operand is being evaluated. Only
+    # worth it when the right operand contains another join, otherwise the filter
+    # would drop the same tuples the probe drops anyway
+    def evaluate_hash_join(self, assignments, filters):
+        left_value = evaluate_operand(self.left, assignments, filters)
+        if not contains_join(self.right):
+            right_value = evaluate_operand(self.right, assignments, filters)
+            if self.operator == "join":
+                return natural_join(left_value, right_value)
+            return theta_join(left_value, right_value, self.operator[1])
+        right_names = self.right.relation_type.column_names
+        if self.operator == "join":
+            key_columns = find_common_columns(left_value.column_names, right_names)
+        else:
+            key_columns = equality_columns(
+                self.operator[1], left_value.column_names, right_names
+            )
+        if len(key_columns) == 0:
+            right_value = evaluate_operand(self.right, assignments, filters)
+            table = None
+        else:
+            table = build_hash_table(
+                left_value.tuples, key_getter([i for i, _ in key_columns])
+            )
+            bloom_filter = BloomFilter(
+                tuple(right_names[j] for _, j in key_columns), len(table)
+            )
+            for key in table:
+                bloom_filter.add(key)
+            right_value = evaluate_operand(
+                self.right, assignments, tuple(filters) + (bloom_filter,)
+            )
+            self.rows_eliminated = bloom_filter.rows_eliminated
+        if self.operator == "join":
+            return natural_join(left_value, right_value, table)
+        return theta_join(left_value, right_value, self.operator[1], table=table)
+
 
 class UnaryExpression:
     def __init__(self, expression, operator):
         self.expression = expression
         self.operator = operator
+        self.type_checked = False
+        self.relation_type = None
+        self.relational = isinstance(operator, tuple)
 
     def __repr__(self):
         return f"UnaryExpression{{{self.operator} {self.expression}}}"
 
-    def evaluate(self, assignments):
-        value = self.expression.evaluate(assignments)
+    def evaluate(self, assignments, filters=()):
+        if not self.relational:
+            value = self.expression.evaluate(assignments)
+        else:
+            match self.operator:
+                case ("order_by", sort_keys):
+                    return order_by(self.expression, sort_keys, assignments)
+                case ("limit", count):
+                    return limit(self.expression, count, assignments)
+            value = evaluate_operand(
+                self.expression, assignments, self.passed_filters(filters)
+            )
+        if not self.type_checked:
+            self.check_value(value)
+        match self.operator:
+            case "!":
+                return not value
+            case "is_null":
+                return value == "NULL"
+            case ("select", condition):
+                if not accepts_filters(self.expression):
+                    value = apply_filters(value, filters)
+                return select(value, condition)
+            case ("project", column_names):
+                return project(value, column_names)
+
+    # NOTE: A select hands the filters on when its operand can carry them to a scan,
+    # otherwise it applies them itself before evaluating its condition
+    def passed_filters(self, filters):
+        match self.operator:
+            case ("select", _):
+                if accepts_filters(self.expression):
+                    return filters
+            case ("project", column_names):
+                return tuple(
+                    bloom_filter
+                    for bloom_filter in filters
+                    if bloom_filter.applies_to(column_names)
+                )
+        return ()
+
+    def check_value(self, value):
         if self.operator != "is_null" and value == "NULL":
             raise EvaluationException(f"Cannot use NULL with operator {self.operator}")
         if self.operator == "!" and not isinstance(value, bool):
@@ -119,15 +239,44 @@ class UnaryExpression:
             raise EvaluationException(
                 f"Operator {self.operator} expected a relation but got type: {type(value)}"
             )
+
+
+# NOTE: insert into / delete from, the rows are either literal tuples or a query
+class Statement:
+    def __init__(self, operator, relation_name, source):
+        self.operator = operator
+        self.relation_name = relation_name
+        self.source = source
+
+    def __repr__(self):
+        return f"Statement{{{self.operator} {self.relation_name} {self.source}}}"
+
+    def evaluate(self, assignments, filters=()):
+        if not isinstance(assignments, Snapshot):
+            raise EvaluationException("insert/delete need a catalog snapshot")
+        catalog = assignments.catalog
+        relation = self.relation_name.evaluate(assignments)
+        tuples = self.rows(relation, assignments)
         match self.operator:
-            case "!":
-                return not value
-            case "is_null":
-                return value == "NULL"
-            case ("select", condition):
-                return select(value, condition)
-            case ("project", column_names):
-                return project(value, column_names)
+            case "insert":
+                catalog.insert(self.relation_name, tuples, assignments)
+                return f"Inserted {len(tuples)} tuples into '{self.relation_name}'"
+            case "delete":
+                count = catalog.delete(self.relation_name, tuples, assignments)
+                return f"Deleted {count} tuples from '{self.relation_name}'"
+
+    def rows(self, relation, assignments):
+        if isinstance(self.source, list):
+            for tup in self.source:
+                if len(tup) != len(relation.column_names):
+                    raise EvaluationException(
+                        f"Tuple size mismatch, expected {len(relation.column_names)} values but got {len(tup)}"
+                    )
+            return self.source
+        column_names, _, rows = stream_tuples(self.source, assignments)
+        if tuple(column_names) != tuple(relation.column_names):
+            raise EvaluationException("Column names do not match")
+        return list(rows)
 
 
 class EvaluationException(Exception):
@@ -135,7 +284,7 @@ class EvaluationException(Exception):
 
 
 class Identifier(str):
-    def evaluate(self, assignments):
+    def evaluate(self, assignments, filters=()):
         try:
             return assignments[self]
         except KeyError:
@@ -144,21 +293,240 @@ class Identifier(str):
 
 
 class IntegerLiteral(int):
-    def evaluate(self, assignments):
+    def evaluate(self, assignments, filters=()):
         return self
 
 
 class StringLiteral(str):
-    def evaluate(self, assignments):
+    def evaluate(self, assignments, filters=()):
         return self
 
 
-class Relation:
-    def __init__(self, column_names, tuples):
+QUERY_MEMORY_LIMIT = None
+GLOBAL_MEMORY_LIMIT = None
+QUERY_TIMEOUT = None
+CHECKPOINT_INTERVAL = 1024
+TUPLE_BYTES = sys.getsizeof(())
+POINTER_BYTES = 8
+
+
+class QueryCancelledException(EvaluationException):
+    pass
+
+
+# NOTE: Bytes held by all running queries together
+# NOTE: The lock is reentrant because a garbage collection while it is held can free
+# tracked objects, whose __del__ takes it again on the same thread
+class MemoryAccount:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.bytes = 0
+        self.peak_bytes = 0
+
+    def check(self, size):
+        if GLOBAL_MEMORY_LIMIT != None and self.bytes + size > GLOBAL_MEMORY_LIMIT:
+            raise EvaluationException(
+                f"Queries exceeded the global memory limit of {GLOBAL_MEMORY_LIMIT} bytes"
+            )
+        self.peak_bytes = max(self.peak_bytes, self.bytes + size)
+
+    def allocate(self, size):
+        with self.lock:
+            self.check(size)
+            self.bytes += size
+
+
+global_memory = MemoryAccount()
+query_state = threading.local()
+
+
+# NOTE: Accounts for the tuples, hash tables and buffers of one query, tracked objects
+# give their bytes back when they are freed and the rest is given back when it ends
+class QueryTracker:
+    def __init__(self, memory_limit=None, timeout=None):
+        if memory_limit == None:
+            memory_limit = QUERY_MEMORY_LIMIT
+        if timeout == None:
+            timeout = QUERY_TIMEOUT
+        self.memory_limit = memory_limit
+        self.timeout = timeout
+        self.deadline = None
+        self.bytes = 0
+        self.peak_bytes = 0
+        self.closed = False
+
+    def __enter__(self):
+        self.previous = current_tracker()
+        query_state.tracker = self
+        if self.timeout != None:
+            self.deadline = time.monotonic() + self.timeout
+        return self
+
+    def __exit__(self, *exception):
+        query_state.tracker = self.previous
+        with global_memory.lock:
+            self.closed = True
+            global_memory.bytes -= self.bytes
+            self.bytes = 0
+
+    # NOTE: Pending bytes are about to be allocated, e.g. a result that is being built
+    def check(self, pending=0):
+        if self.deadline != None and time.monotonic() > self.deadline:
+            raise QueryCancelledException(
+                f"Query timed out after {self.timeout} seconds"
+            )
+        if self.memory_limit != None and self.bytes + pending > self.memory_limit:
+            raise EvaluationException(
+                f"Query exceeded its memory limit of {self.memory_limit} bytes"
+            )
+        self.peak_bytes = max(self.peak_bytes, self.bytes + pending)
+        with global_memory.lock:
+            global_memory.check(pending)
+
+    def track(self, tracked, size):
+        self.check(size)
+        global_memory.allocate(size)
+        self.bytes += size
+        tracked.tracker = self
+        tracked.tracked_bytes = size
+
+    def free(self, size):
+        with global_memory.lock:
+            if not self.closed:
+                self.bytes -= size
+                global_memory.bytes -= size
+
+
+class Tracked:
+    tracker = None
+
+    def __del__(self):
+        if self.tracker != None:
+            self.tracker.free(self.tracked_bytes)
+
+
+class HashTable(Tracked, dict):
+    pass
+
+
+def current_tracker():
+    return getattr(query_state, "tracker", None)
+
+
+def checkpoint(pending=0):
+    tracker = current_tracker()
+    if tracker != None:
+        tracker.check(pending)
+
+
+def track(tracked, size):
+    tracker = current_tracker()
+    if tracker != None:
+        tracker.track(tracked, size)
+    return tracked
+
+
+# NOTE: Without a width the tuples are shared with another relation, so only the
+# references to them are counted
+def tuples_size(count, width=None):
+    size = count * POINTER_BYTES
+    if width != None:
+        size += count * (TUPLE_BYTES + width * POINTER_BYTES)
+    return size
+
+
+def track_relation(relation, new_tuples=False):
+    width = len(relation.column_names) if new_tuples else None
+    return track(relation, tuples_size(len(relation.tuples), width))
+
+
+def hash_table_size(table):
+    return sys.getsizeof(table) + sum(sys.getsizeof(rows) for rows in table.values())
+
+
+# NOTE: With a width the rows are assumed to be collected into a list by the consumer
+def checked_rows(rows, width=None):
+    count = 0
+    for chunk in iter(lambda: list(itertools.islice(rows, CHECKPOINT_INTERVAL)), []):
+        count += len(chunk)
+        if width == None:
+            checkpoint()
+        else:
+            checkpoint(tuples_size(count, width))
+        yield from chunk
+
+
+def value_type(value):
+    if isinstance(value, IntegerLiteral):
+        return int
+    if isinstance(value, StringLiteral):
+        return str
+    return None
+
+
+# NOTE: A type of None means the type is unknown (e.g. the column has no values)
+class ColumnType:
+    def __init__(self, type, nullable=False):
+        self.type = type
+        self.nullable = nullable
+
+    def __repr__(self):
+        name = "unknown" if self.type == None else self.type.__name__
+        if self.nullable:
+            return f"{name} (nullable)"
+        return name
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, ColumnType)
+            and self.type == other.type
+            and self.nullable == other.nullable
+        )
+
+
+def infer_column_types(column_names, tuples):
+    column_types = []
+    for i in range(len(column_names)):
+        column_type = ColumnType(None)
+        for tup in tuples:
+            if tup[i] == "NULL":
+                column_type.nullable = True
+            elif column_type.type == None:
+                column_type.type = value_type(tup[i])
+        column_types.append(column_type)
+    return tuple(column_types)
+
+
+# NOTE: Only the new rows are checked, the existing column types are widened to
+# nullable or given a type when they had none
+def merge_column_types(column_names, column_types, tuples):
+    merged = [ColumnType(t.type, t.nullable) for t in column_types]
+    for tup in tuples:
+        for i, value in enumerate(tup):
+            if value == "NULL":
+                merged[i].nullable = True
+            elif merged[i].type == None:
+                merged[i].type = value_type(value)
+            elif merged[i].type != value_type(value):
+                raise TypeCheckException(f"Type mismatch in column '{column_names[i]}'")
+    return tuple(merged)
+
+
+class Relation(Tracked):
+    def __init__(self, column_names, tuples, column_types=None):
         self.column_names = column_names
         self.tuples = tuples
+        self.column_types = column_types
+
+    def schema(self):
+        if self.column_types == None:
+            self.column_types = infer_column_types(self.column_names, self.tuples)
+        return self.column_types
 
     def __repr__(self):
+        return "\n".join(self.lines())
+
+    def lines(self):
         widths = [len(name) for name in self.column_names]
         for tup in self.tuples:
             for i, value in enumerate(tup):
@@ -166,42 +534,158 @@ class Relation:
                 if length > widths[i]:
                     widths[i] = length
 
-        line = "".join("+" + "-" * (w + 2) for w in widths) + "+\n"
-        output = line
-        output += (
+        line = "".join("+" + "-" * (w + 2) for w in widths) + "+"
+        yield line
+        yield (
             "".join(
                 f"| {name:<{widths[i]}} " for i, name in enumerate(self.column_names)
             )
-            + "|\n"
+            + "|"
         )
-        output += line
+        yield line
         for tup in self.tuples:
-            output += (
-                "".join(f"| {value:<{widths[i]}} " for i, value in enumerate(tup))
-                + "|\n"
+            yield "".join(
+                f"| {value:<{widths[i]}} " for i, value in enumerate(tup)
+            ) + "|"
+        yield line
+
+
+class Snapshot:
+    def __init__(self, catalog, version, relations):
+        self.catalog = catalog
+        self.version = version
+        self.relations = relations
+
+    def __getitem__(self, name):
+        return self.relations[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.catalog.release(self)
+
+
+# NOTE: Relations that a snapshot can see must never be modified, a new version is
+# published instead. insert and delete change the relation in place when no other
+# snapshot can see it, so appending a few tuples does not copy the whole relation
+class Catalog:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.versions = {0: {}}
+        self.readers = {}
+
+    def snapshot(self):
+        with self.lock:
+            self.readers[self.version] = self.readers.get(self.version, 0) + 1
+            return Snapshot(self, self.version, self.versions[self.version])
+
+    def release(self, snapshot):
+        with self.lock:
+            self.readers[snapshot.version] -= 1
+            if self.readers[snapshot.version] == 0:
+                del self.readers[snapshot.version]
+            self.collect()
+
+    def publish(self, name, relation):
+        with self.lock:
+            self.put(name, relation)
+
+    def put(self, name, relation):
+        relations = self.versions[self.version].copy()
+        relations[name] = relation
+        self.version += 1
+        self.versions[self.version] = relations
+        self.collect()
+
+    # NOTE: The writer's own snapshot does not count, it has finished reading
+    def is_shared(self, name, relation, snapshot):
+        for version, readers in self.readers.items():
+            if version == snapshot.version:
+                readers -= 1
+            if readers > 0 and self.versions[version].get(name) is relation:
+                return True
+        return False
+
+    def current(self, name):
+        relation = self.versions[self.version].get(name)
+        if relation == None:
+            raise EvaluationException(f"Unknown identifier '{name}'")
+        return relation
+
+    # NOTE: The statement's rows were checked against the relation in its snapshot, so
+    # the latest version must still have the same columns
+    def writable(self, name, snapshot):
+        relation = self.current(name)
+        if tuple(relation.column_names) != tuple(snapshot[name].column_names):
+            raise EvaluationException(
+                f"Relation '{name}' was redefined while the statement was running"
+            )
+        return relation
+
+    def insert(self, name, tuples, snapshot):
+        with self.lock:
+            relation = self.writable(name, snapshot)
+            column_types = merge_column_types(
+                relation.column_names, relation.schema(), tuples
             )
-        output += line
-        return output[:-1]
+            if self.is_shared(name, relation, snapshot):
+                relation = Relation(
+                    relation.column_names, relation.tuples + tuples, column_types
+                )
+            else:
+                relation.tuples.extend(tuples)
+                relation.column_types = column_types
+            self.put(name, relation)
+
+    def delete(self, name, tuples, snapshot):
+        keys = set(tuples)
+        with self.lock:
+            relation = self.writable(name, snapshot)
+            kept = [tup for tup in relation.tuples if tup not in keys]
+            count = len(relation.tuples) - len(kept)
+            if self.is_shared(name, relation, snapshot):
+                relation = Relation(relation.column_names, kept, relation.column_types)
+            else:
+                relation.tuples[:] = kept
+            self.put(name, relation)
+        return count
+
+    def collect(self):
+        for version in list(self.versions):
+            if version != self.version and version not in self.readers:
+                del self.versions[version]
+
+
+def is_type_checked(condition):
+    return (
+        isinstance(condition, (BinaryExpression, UnaryExpression))
+        and condition.type_checked
+    )
 
 
 def select(relation, condition):
     tuples = []
     assignments = {}
+    check_result = not is_type_checked(condition)
+
+    for start in range(0, len(relation.tuples), CHECKPOINT_INTERVAL):
+        checkpoint(tuples_size(len(tuples)))
+        for tup in relation.tuples[start : start + CHECKPOINT_INTERVAL]:
+            for i in range(len(relation.column_names)):
+                name = relation.column_names[i]
+                value = tup[i]
+                assignments[name] = value
 
-    for tup in relation.tuples:
-        for i in range(len(relation.column_names)):
-            name = relation.column_names[i]
-            value = tup[i]
-            assignments[name] = value
-
-        result = condition.evaluate(assignments)
-        if not isinstance(result, bool):
-            raise EvaluationException("Condition did not evaluate to a boolean")
+            result = condition.evaluate(assignments)
+            if check_result and not isinstance(result, bool):
+                raise EvaluationException("Condition did not evaluate to a boolean")
 
-        if result:
-            tuples.append(tup)
+            if result:
+                tuples.append(tup)
 
-    return Relation(relation.column_names, tuples)
+    return track_relation(Relation(relation.column_names, tuples))
 
 
 def index_of(tup, value):
@@ -218,12 +702,14 @@ def project(relation, column_names):
 
     tuples = []
     for tup in relation.tuples:
+        if len(tuples) % CHECKPOINT_INTERVAL == 0:
+            checkpoint(tuples_size(len(tuples), len(indices)))
         new_tuple = tuple()
         for i in indices:
             new_tuple += (tup[i],)
         tuples.append(new_tuple)
 
-    return Relation(column_names, tuples)
+    return track_relation(Relation(column_names, tuples), new_tuples=True)
 
 
 def contains(tuples, tup):
@@ -237,30 +723,36 @@ def union(relation_a, relation_b):
     if relation_a.column_names != relation_b.column_names:
         raise EvaluationException("Column names do not match")
     tuples = relation_a.tuples.copy()
-    for tup in relation_b.tuples:
+    for row, tup in enumerate(relation_b.tuples):
+        if row % CHECKPOINT_INTERVAL == 0:
+            checkpoint(tuples_size(len(tuples)))
         if not contains(relation_a.tuples, tup):
             tuples.append(tup)
-    return Relation(relation_a.column_names, tuples)
+    return track_relation(Relation(relation_a.column_names, tuples))
 
 
 def intersect(relation_a, relation_b):
     if relation_a.column_names != relation_b.column_names:
         raise EvaluationException("Column names do not match")
     tuples = []
-    for tup in relation_a.tuples:
+    for row, tup in enumerate(relation_a.tuples):
+        if row % CHECKPOINT_INTERVAL == 0:
+            checkpoint(tuples_size(len(tuples)))
         if contains(relation_b.tuples, tup):
             tuples.append(tup)
-    return Relation(relation_a.column_names, tuples)
+    return track_relation(Relation(relation_a.column_names, tuples))
 
 
 def subtract(relation_a, relation_b):
     if relation_a.column_names != relation_b.column_names:
         raise EvaluationException("Column names do not match")
     tuples = []
-    for tup in relation_a.tuples:
+    for row, tup in enumerate(relation_a.tuples):
+        if row % CHECKPOINT_INTERVAL == 0:
+            checkpoint(tuples_size(len(tuples)))
         if not contains(relation_b.tuples, tup):
             tuples.append(tup)
-    return Relation(relation_a.column_names, tuples)
+    return track_relation(Relation(relation_a.column_names, tuples))
 
 
 # NOTE: Returns None if common columns do not match
@@ -282,27 +774,89 @@ def natural_join_tuples(tuple_a, tuple_b, common_columns):
     return joined_tuple
 
 
-def natural_join(relation_a, relation_b):
+def find_common_columns(names_a, names_b):
     common_columns = []
-    for i in range(len(relation_a.column_names)):
+    for i in range(len(names_a)):
         try:
-            name = relation_a.column_names[i]
-            j = index_of(relation_b.column_names, name)
+            j = index_of(names_b, names_a[i])
         except ValueError:
             continue
         common_columns.append((i, j))
+    return common_columns
 
-    tuples = []
-    for tuple_a in relation_a.tuples:
-        for tuple_b in relation_b.tuples:
-            joined_tuple = natural_join_tuples(tuple_a, tuple_b, common_columns)
-            if joined_tuple != None:
-                tuples.append(joined_tuple)
 
+def build_hash_table(tuples, key):
+    table = HashTable()
+    for i, tup in enumerate(tuples):
+        if i % CHECKPOINT_INTERVAL == 0:
+            checkpoint(tuples_size(i))
+        table.setdefault(key(tup), []).append(i)
+    return track(table, hash_table_size(table))
+
+
+# NOTE: Maps each index of relation_a to the indices of relation_b it may join with
+def probe_hash_table(table, tuples, key):
+    candidates = {}
+    for j, tup in enumerate(tuples):
+        if j % CHECKPOINT_INTERVAL == 0:
+            checkpoint(tuples_size(len(candidates)))
+        for i in table.get(key(tup), ()):
+            candidates.setdefault(i, []).append(j)
+    return candidates
+
+
+def natural_join(relation_a, relation_b, table=None):
+    common_columns = find_common_columns(
+        relation_a.column_names, relation_b.column_names
+    )
+    if table == None:
+        table = build_hash_table(
+            relation_a.tuples, key_getter([i for i, _ in common_columns])
+        )
+    candidates = probe_hash_table(
+        table, relation_b.tuples, key_getter([j for _, j in common_columns])
+    )
+
+    common_b = [j for _, j in common_columns]
+    rest_b = [j for j in range(len(relation_b.column_names)) if j not in common_b]
     column_names = natural_join_tuples(
         relation_a.column_names, relation_b.column_names, common_columns
     )
-    return Relation(column_names, tuples)
+    tuples = []
+    for i, tuple_a in enumerate(relation_a.tuples):
+        checkpoint(tuples_size(len(tuples), len(column_names)))
+        for j in candidates.get(i, ()):
+            tuple_b = relation_b.tuples[j]
+            tuples.append(tuple_a + tuple(tuple_b[k] for k in rest_b))
+
+    return track_relation(Relation(column_names, tuples), new_tuples=True)
+
+
+def key_getter(indices):
+    if len(indices) == 0:
+        return lambda tup: ()
+    return operator.itemgetter(*indices)
+
+
+# NOTE: Keeps the tuples of relation_a that have (or with anti, do not have) a match
+def semi_join(relation_a, relation_b, anti=False):
+    common_columns = find_common_columns(
+        relation_a.column_names, relation_b.column_names
+    )
+    key_a = key_getter([i for i, _ in common_columns])
+    key_b = key_getter([j for _, j in common_columns])
+
+    keys = set()
+    for tup in relation_b.tuples:
+        keys.add(key_b(tup))
+    checkpoint(sys.getsizeof(keys))
+
+    tuples = []
+    for tup in relation_a.tuples:
+        if (key_a(tup) in keys) != anti:
+            tuples.append(tup)
+    relation = Relation(relation_a.column_names, tuples, relation_a.column_types)
+    return track_relation(relation)
 
 
 def disjoint_column_names(names_a, names_b):
@@ -313,15 +867,64 @@ def disjoint_column_names(names_a, names_b):
     return True
 
 
-def theta_join(relation_a, relation_b, condition, left_outer=False, right_outer=False):
+# NOTE: Pairs (i, j) of columns compared with == at the top level of the condition, only
+# when no part of the condition can raise on NULL, so skipping unequal pairs is safe
+def equality_columns(condition, names_a, names_b):
+    if not is_null_safe(condition):
+        return []
+    key_columns = []
+    for conjunct in conjuncts(condition):
+        if not isinstance(conjunct, BinaryExpression) or conjunct.operator != "==":
+            continue
+        left, right = conjunct.left, conjunct.right
+        if not isinstance(left, Identifier) or not isinstance(right, Identifier):
+            continue
+        if right in names_a and left in names_b:
+            left, right = right, left
+        if left in names_a and right in names_b:
+            key_columns.append((index_of(names_a, left), index_of(names_b, right)))
+    return key_columns
+
+
+def is_null_safe(condition):
+    if isinstance(condition, BinaryExpression):
+        return (
+            condition.type_checked
+            and not condition.nullable
+            and is_null_safe(condition.left)
+            and is_null_safe(condition.right)
+        )
+    if isinstance(condition, UnaryExpression):
+        return condition.type_checked and is_null_safe(condition.expression)
+    return True
+
+
+def theta_join(
+    relation_a, relation_b, condition, left_outer=False, right_outer=False, table=None
+):
     if not disjoint_column_names(relation_a.column_names, relation_b.column_names):
         raise EvaluationException(
             "When using join with a condition the column names must be disjoint"
         )
 
+    candidates = None
+    key_columns = equality_columns(
+        condition, relation_a.column_names, relation_b.column_names
+    )
+    if len(key_columns) > 0:
+        if table == None:
+            table = build_hash_table(
+                relation_a.tuples, key_getter([i for i, _ in key_columns])
+            )
+        candidates = probe_hash_table(
+            table, relation_b.tuples, key_getter([j for _, j in key_columns])
+        )
+    all_indices = range(len(relation_b.tuples))
+
     tuples = []
     column_names = relation_a.column_names + relation_b.column_names
     assignments = {}
+    check_result = not is_type_checked(condition)
 
     b_matches = []
     for _ in relation_b.tuples:
@@ -336,9 +939,15 @@ def theta_join(relation_a, relation_b, condition, left_outer=False, right_outer=
         for _ in range(len(relation_a.column_names)):
             null_tuple_a += ("NULL",)
 
-    for tuple_a in relation_a.tuples:
+    for a_index, tuple_a in enumerate(relation_a.tuples):
+        checkpoint(tuples_size(len(tuples), len(column_names)))
         match_found = False
-        for i, tuple_b in enumerate(relation_b.tuples):
+        if candidates == None:
+            indices = all_indices
+        else:
+            indices = candidates.get(a_index, ())
+        for i in indices:
+            tuple_b = relation_b.tuples[i]
             joined_tuple = tuple_a + tuple_b
 
             for j in range(len(column_names)):
@@ -347,7 +956,7 @@ def theta_join(relation_a, relation_b, condition, left_outer=False, right_outer=
                 assignments[name] = value
 
             result = condition.evaluate(assignments)
-            if not isinstance(result, bool):
+            if check_result and not isinstance(result, bool):
                 raise EvaluationException("Condition did not evaluate to a boolean")
 
             if result:
@@ -362,14 +971,923 @@ def theta_join(relation_a, relation_b, condition, left_outer=False, right_outer=
             if not b_matches[i]:
                 tuples.append(null_tuple_a + tuple_b)
 
-    return Relation(column_names, tuples)
+    return track_relation(Relation(column_names, tuples), new_tuples=True)
+
+
+BLOOM_FILTERS = True
+BLOOM_FILTER_FALSE_POSITIVE_RATE = 0.01
+BLOOM_FILTER_MAX_BITS = 1 << 24
+
+
+# NOTE: Sized for the expected number of keys and false positive rate, uses double
+# hashing to derive all bit positions from a single hash of the key
+class BloomFilter(Tracked):
+    def __init__(self, column_names, capacity, false_positive_rate=None):
+        if false_positive_rate == None:
+            false_positive_rate = BLOOM_FILTER_FALSE_POSITIVE_RATE
+        capacity = max(capacity, 1)
+        size = int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+        self.size = min(max(size, 64), BLOOM_FILTER_MAX_BITS)
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.column_names = column_names
+        self.rows_eliminated = 0
+        track(self, sys.getsizeof(self.bits))
+
+    def positions(self, key):
+        value = hash((key,)) & 0xFFFFFFFFFFFFFFFF
+        first = value & 0xFFFFFFFF
+        step = (value >> 32) | 1
+        return [(first + i * step) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        for position in self.positions(key):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def applies_to(self, column_names):
+        return all(name in column_names for name in self.column_names)
+
+    def filter(self, relation):
+        key = key_getter(
+            [index_of(relation.column_names, name) for name in self.column_names]
+        )
+        tuples = [tup for tup in relation.tuples if key(tup) in self]
+        self.rows_eliminated += len(relation.tuples) - len(tuples)
+        return track_relation(
+            Relation(relation.column_names, tuples, relation.column_types)
+        )
+
+
+# NOTE: Relations named directly are filtered here, so looking up the identifiers of a
+# condition for every tuple does not pay for it
+def evaluate_operand(node, assignments, filters):
+    value = node.evaluate(assignments, filters)
+    if filters and isinstance(node, Identifier) and isinstance(value, Relation):
+        return apply_filters(value, filters)
+    return value
+
+
+def apply_filters(relation, filters):
+    for bloom_filter in filters:
+        if bloom_filter.applies_to(relation.column_names):
+            relation = bloom_filter.filter(relation)
+    return relation
+
+
+def is_hash_join(node):
+    match node.operator:
+        case "join" | ("theta_join", _):
+            return True
+    return False
+
+
+# NOTE: Filters can only move into operands whose dropped tuples could never reach
+# the output, so outer joins and the right side of set differences stop them
+def passed_filters(operator, filters):
+    match operator:
+        case "union" | "join" | ("theta_join", _):
+            return filters, filters
+        case "intersect" | "minus" | "semi_join" | "anti_join":
+            return filters, ()
+    return (), ()
+
+
+def accepts_filters(node):
+    if isinstance(node, UnaryExpression):
+        match node.operator:
+            case ("select", _) | ("project", _):
+                return True
+        return False
+    if isinstance(node, BinaryExpression):
+        left_filters, _ = passed_filters(node.operator, (True,))
+        return len(left_filters) > 0
+    return isinstance(node, Identifier)
+
+
+def contains_join(node):
+    if isinstance(node, UnaryExpression):
+        return contains_join(node.expression)
+    if isinstance(node, BinaryExpression):
+        return (
+            is_hash_join(node) or contains_join(node.left) or contains_join(node.right)
+        )
+    return False
+
+
+# NOTE: Bloom filters only pay off when a join's right operand contains another join
+def contains_join_chain(node):
+    if isinstance(node, UnaryExpression):
+        return contains_join_chain(node.expression)
+    if isinstance(node, BinaryExpression):
+        if is_hash_join(node) and contains_join(node.right):
+            return True
+        return contains_join_chain(node.left) or contains_join_chain(node.right)
+    return False
+
+
+def bloom_filter_rows_eliminated(node):
+    if isinstance(node, UnaryExpression):
+        return bloom_filter_rows_eliminated(node.expression)
+    if isinstance(node, BinaryExpression):
+        return (
+            node.rows_eliminated
+            + bloom_filter_rows_eliminated(node.left)
+            + bloom_filter_rows_eliminated(node.right)
+        )
+    return 0
+
+
+EXTERNAL_SORT_RUN_SIZE = 100000
+EXTERNAL_SORT_CHUNK_SIZE = 1000
+
+
+class Descending:
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+# NOTE: NULLs are sorted last in ascending order and first in descending order
+def sort_key(column_names, column_types, sort_keys):
+    reverse = all(descending for _, descending in sort_keys)
+    columns = []
+    for name, descending in sort_keys:
+        i = index_of(column_names, name)
+        columns.append((i, column_types[i].nullable, descending and not reverse))
+
+    if not any(nullable or descending for _, nullable, descending in columns):
+        return operator.itemgetter(*[i for i, _, _ in columns]), reverse
+
+    def key(tup):
+        values = []
+        for i, nullable, descending in columns:
+            value = tup[i]
+            if nullable:
+                values.append((value == "NULL") != descending)
+            values.append(Descending(value) if descending else value)
+        return values
+
+    return key, reverse
+
+
+def write_run(tuples):
+    file = tempfile.TemporaryFile()
+    for i in range(0, len(tuples), EXTERNAL_SORT_CHUNK_SIZE):
+        pickle.dump(tuples[i : i + EXTERNAL_SORT_CHUNK_SIZE], file)
+    file.seek(0)
+    return file
+
+
+def read_run(file):
+    while True:
+        try:
+            chunk = pickle.load(file)
+        except EOFError:
+            return
+        yield from chunk
+
+
+# NOTE: Larger inputs are sorted in runs that are written to disk and then merged
+def sort_tuples(rows, key, reverse):
+    run = list(itertools.islice(rows, EXTERNAL_SORT_RUN_SIZE))
+    checkpoint(tuples_size(len(run)))
+    run.sort(key=key, reverse=reverse)
+    if len(run) < EXTERNAL_SORT_RUN_SIZE:
+        return run
+
+    files = [write_run(run)]
+    try:
+        while True:
+            run = list(itertools.islice(rows, EXTERNAL_SORT_RUN_SIZE))
+            if len(run) == 0:
+                break
+            run.sort(key=key, reverse=reverse)
+            files.append(write_run(run))
+        runs = [read_run(file) for file in files]
+        return list(heapq.merge(*runs, key=key, reverse=reverse))
+    finally:
+        for file in files:
+            file.close()
+
+
+def order_by(node, sort_keys, assignments):
+    column_names, column_types, rows = stream_tuples(node, assignments)
+    key, reverse = sort_key(column_names, column_types, sort_keys)
+    tuples = sort_tuples(checked_rows(rows), key, reverse)
+    relation = Relation(column_names, tuples, column_types)
+    return track_relation(relation, new_tuples=True)
+
+
+def limit(node, count, assignments):
+    if isinstance(node, UnaryExpression) and isinstance(node.operator, tuple):
+        is_sorted = node.operator[0] == "order_by"
+    else:
+        is_sorted = False
+    if is_sorted:
+        column_names, column_types, rows = stream_tuples(node.expression, assignments)
+        key, reverse = sort_key(column_names, column_types, node.operator[1])
+        if reverse:
+            tuples = heapq.nlargest(count, checked_rows(rows), key=key)
+        else:
+            tuples = heapq.nsmallest(count, checked_rows(rows), key=key)
+    else:
+        column_names, column_types, rows = stream_tuples(node, assignments)
+        tuples = list(itertools.islice(checked_rows(rows), count))
+    relation = Relation(column_names, tuples, column_types)
+    return track_relation(relation, new_tuples=True)
+
+
+class TypeCheckException(EvaluationException):
+    pass
+
+
+class RelationType:
+    def __init__(self, column_names, column_types):
+        self.column_names = column_names
+        self.column_types = column_types
+
+    def __repr__(self):
+        return "Relation"
+
+    def columns(self):
+        return dict(zip(self.column_names, self.column_types))
+
+
+def is_scalar(value_type, *types):
+    return isinstance(value_type, ColumnType) and value_type.type in types
+
+
+def operator_name(operator):
+    if isinstance(operator, tuple):
+        return operator[0]
+    return operator
+
+
+# NOTE: Conditions are checked against the columns of the rows they will be evaluated on
+def check_types(node, assignments, columns=None):
+    if isinstance(node, Identifier):
+        if columns == None:
+            relation = node.evaluate(assignments)
+            return RelationType(relation.column_names, relation.schema())
+        if node not in columns:
+            raise TypeCheckException(f"Unknown identifier '{node}'")
+        return columns[node]
+    if isinstance(node, IntegerLiteral):
+        return ColumnType(int)
+    if isinstance(node, StringLiteral):
+        return ColumnType(str)
+    if isinstance(node, UnaryExpression):
+        result = check_unary_types(node, assignments, columns)
+    else:
+        result = check_binary_types(node, assignments, columns)
+    node.type_checked = True
+    if isinstance(result, RelationType):
+        node.relation_type = result
+    return result
+
+
+def check_condition_types(condition, assignments, column_names, column_types):
+    columns = dict(zip(column_names, column_types))
+    if not is_scalar(check_types(condition, assignments, columns), bool):
+        raise TypeCheckException("Condition did not evaluate to a boolean")
+
+
+def check_unary_types(node, assignments, columns):
+    value_type = check_types(node.expression, assignments, columns)
+    if node.operator == "is_null":
+        return ColumnType(bool)
+    if node.operator == "!":
+        if not is_scalar(value_type, bool):
+            raise TypeCheckException(
+                f"Operator ! expected a boolean but got type: {value_type}"
+            )
+        return ColumnType(bool)
+
+    if not isinstance(value_type, RelationType):
+        raise TypeCheckException(
+            f"Operator {node.operator[0]} expected a relation but got type: {value_type}"
+        )
+    match node.operator:
+        case ("select", condition):
+            check_condition_types(
+                condition,
+                assignments,
+                value_type.column_names,
+                value_type.column_types,
+            )
+            return value_type
+        case ("project", column_names):
+            types = value_type.columns()
+            for name in column_names:
+                if name not in types:
+                    raise TypeCheckException(f"Unknown column '{name}'")
+            return RelationType(
+                column_names, tuple(types[name] for name in column_names)
+            )
+        case ("order_by", sort_keys):
+            for name, _ in sort_keys:
+                if name not in value_type.column_names:
+                    raise TypeCheckException(f"Unknown column '{name}'")
+            return value_type
+        case ("limit", _):
+            return value_type
+
+
+def check_binary_types(node, assignments, columns):
+    left_type = check_types(node.left, assignments, columns)
+    right_type = check_types(node.right, assignments, columns)
+    operator = operator_name(node.operator)
+
+    if operator in COMPARISON_OPERATORS:
+        for value_type in [left_type, right_type]:
+            if not is_scalar(value_type, int, str, None):
+                raise TypeCheckException(
+                    f"Operator {operator} expected integers or strings but got type: {value_type}"
+                )
+        if (
+            left_type.type != None
+            and right_type.type != None
+            and left_type.type != right_type.type
+        ):
+            raise TypeCheckException(f"Type mismatch for operands of {operator}")
+        node.nullable = left_type.nullable or right_type.nullable
+        return ColumnType(bool)
+
+    if operator in ["&&", "||"]:
+        for value_type in [left_type, right_type]:
+            if not is_scalar(value_type, bool):
+                raise TypeCheckException(
+                    f"Operator {operator} expected booleans but got type: {value_type}"
+                )
+        node.nullable = False
+        return ColumnType(bool)
+
+    for value_type in [left_type, right_type]:
+        if not isinstance(value_type, RelationType):
+            raise TypeCheckException(
+                f"Operator {operator} expected relations but got type: {value_type}"
+            )
+    node.nullable = False
+
+    if operator in ["union", "intersect", "minus"]:
+        if left_type.column_names != right_type.column_names:
+            raise TypeCheckException("Column names do not match")
+        if operator != "union":
+            return left_type
+        column_types = []
+        for name, a, b in zip(
+            left_type.column_names, left_type.column_types, right_type.column_types
+        ):
+            if a.type != None and b.type != None and a.type != b.type:
+                raise TypeCheckException(f"Type mismatch in column '{name}'")
+            column_type = a.type if a.type != None else b.type
+            column_types.append(ColumnType(column_type, a.nullable or b.nullable))
+        return RelationType(left_type.column_names, tuple(column_types))
+
+    if operator in ["semi_join", "anti_join"]:
+        return left_type
+
+    if operator == "join":
+        column_names = left_type.column_names
+        column_types = left_type.column_types
+        for name, column_type in zip(right_type.column_names, right_type.column_types):
+            if name not in left_type.column_names:
+                column_names += (name,)
+                column_types += (column_type,)
+        return RelationType(column_names, column_types)
+
+    if not disjoint_column_names(left_type.column_names, right_type.column_names):
+        raise TypeCheckException(
+            "When using join with a condition the column names must be disjoint"
+        )
+    left_types = left_type.column_types
+    right_types = right_type.column_types
+    if operator in ["right_join", "full_join"]:
+        left_types = tuple(ColumnType(t.type, True) for t in left_types)
+    if operator in ["left_join", "full_join"]:
+        right_types = tuple(ColumnType(t.type, True) for t in right_types)
+    column_names = left_type.column_names + right_type.column_names
+    check_condition_types(
+        node.operator[1],
+        assignments,
+        column_names,
+        left_type.column_types + right_type.column_types,
+    )
+    return RelationType(column_names, left_types + right_types)
+
+
+# NOTE: Both sides of intersect and minus have the same columns, so matching on the
+# common columns is the same as comparing whole tuples and the result is unchanged
+def optimize(node, assignments):
+    if isinstance(node, UnaryExpression):
+        node.expression = optimize(node.expression, assignments)
+        return node
+    if isinstance(node, BinaryExpression):
+        node.left = optimize(node.left, assignments)
+        node.right = optimize(node.right, assignments)
+        match node.operator:
+            case "intersect":
+                node.operator = "semi_join"
+            case "minus":
+                node.operator = "anti_join"
+    return node
+
+
+class UnsupportedNodeException(Exception):
+    pass
+
+
+class CompiledColumn:
+    def __init__(self, name, var, type, nullable):
+        self.name = name
+        self.var = var
+        self.type = type
+        self.nullable = nullable
+
+
+def column_vars(columns):
+    return "".join(f"{column.var}, " for column in columns)
+
+
+def key_code(columns):
+    if len(columns) == 1:
+        return columns[0].var
+    return f"({column_vars(columns)})"
+
+
+class ScanPlan:
+    def __init__(self, compiler, relation, column_types):
+        self.relation = relation
+        self.source = compiler.add_source(relation)
+        self.row = compiler.new_var("t")
+        self.columns = []
+        for name, column_type in zip(relation.column_names, column_types):
+            self.columns.append(
+                CompiledColumn(
+                    name, compiler.new_var("c"), column_type.type, column_type.nullable
+                )
+            )
+
+    def produce(self, compiler, consume, indent):
+        count = compiler.new_var("n")
+        compiler.emit(indent, f"{count} = 0")
+        compiler.emit(indent, f"for {self.row} in {self.source}:")
+        compiler.emit_checkpoint(indent + 1, count)
+        compiler.emit(indent + 1, f"{column_vars(self.columns)}= {self.row}")
+        consume(indent + 1)
+
+
+class FilterPlan:
+    def __init__(self, child, condition):
+        self.child = child
+        self.condition = condition
+        self.columns = child.columns
+
+    def produce(self, compiler, consume, indent):
+        def consume_filter(indent):
+            compiler.emit(indent, f"if {self.condition}:")
+            consume(indent + 1)
+
+        self.child.produce(compiler, consume_filter, indent)
+
+
+class ProjectPlan:
+    def __init__(self, child, columns):
+        self.child = child
+        self.columns = columns
+
+    def produce(self, compiler, consume, indent):
+        self.child.produce(compiler, consume, indent)
+
+
+# NOTE: The build side is materialized first, then each probe tuple looks up its matches
+class JoinPlan:
+    def __init__(self, probe, build, probe_keys, build_keys, condition, columns):
+        self.probe = probe
+        self.build = build
+        self.probe_keys = probe_keys
+        self.build_keys = build_keys
+        self.condition = condition
+        self.columns = columns
+
+    def produce(self, compiler, consume, indent):
+        table = compiler.new_var("h")
+        build_vars = column_vars(self.build.columns)
+        if len(self.build_keys) > 0:
+            build_key = key_code(self.build_keys)
+            compiler.emit(indent, f"{table} = HashTable()")
+            insert = f"{table}.setdefault({build_key}, []).append(({build_vars}))"
+            matches = f"{table}.get({key_code(self.probe_keys)}, ())"
+        else:
+            compiler.emit(indent, f"{table} = []")
+            insert = f"{table}.append(({build_vars}))"
+            matches = table
+        self.build.produce(
+            compiler, lambda indent: compiler.emit(indent, insert), indent
+        )
+        if len(self.build_keys) > 0:
+            compiler.emit(indent, f"track({table}, hash_table_size({table}))")
+        else:
+            width = len(self.build.columns)
+            compiler.emit(indent, f"checkpoint(tuples_size(len({table}), {width}))")
+
+        count = compiler.new_var("n")
+        compiler.emit(indent, f"{count} = 0")
+
+        def consume_probe(indent):
+            compiler.emit(indent, f"for {build_vars}in {matches}:")
+            compiler.emit_checkpoint(indent + 1, count)
+            if self.condition == None:
+                consume(indent + 1)
+                return
+            compiler.emit(indent + 1, f"if {self.condition}:")
+            consume(indent + 2)
+
+        self.probe.produce(compiler, consume_probe, indent)
+
+
+class SemiJoinPlan:
+    def __init__(self, probe, build, probe_keys, build_keys, anti):
+        self.probe = probe
+        self.build = build
+        self.probe_keys = probe_keys
+        self.build_keys = build_keys
+        self.anti = anti
+        self.columns = probe.columns
+
+    def produce(self, compiler, consume, indent):
+        keys = compiler.new_var("k")
+        insert = f"{keys}.add({key_code(self.build_keys)})"
+        compiler.emit(indent, f"{keys} = set()")
+        self.build.produce(
+            compiler, lambda indent: compiler.emit(indent, insert), indent
+        )
+        compiler.emit(indent, f"checkpoint(tuples_size(len({keys})))")
+
+        test = "not in" if self.anti else "in"
+
+        def consume_probe(indent):
+            compiler.emit(indent, f"if {key_code(self.probe_keys)} {test} {keys}:")
+            consume(indent + 1)
+
+        self.probe.produce(compiler, consume_probe, indent)
+
+
+# NOTE: Feeds every row of one scan to several filters that each append to their own
+# output list, so the compiled function returns nothing instead of yielding rows
+class SharedScanPlan:
+    def __init__(self, scan, filters):
+        self.scan = scan
+        self.filters = filters
+        self.columns = scan.columns
+
+    def produce(self, compiler, consume, indent):
+        def consume_filters(indent):
+            for condition, output in self.filters:
+                compiler.emit(indent, f"if {condition}:")
+                compiler.emit(indent + 1, f"{output}.append({self.scan.row})")
+
+        self.scan.produce(compiler, consume_filters, indent)
+
+
+def not_null(value):
+    if value == "NULL":
+        raise EvaluationException(f"Cannot use NULL in a binary expression")
+    return value
+
+
+COMPILE_QUERIES = True
+COMPILED_QUERY_CACHE_SIZE = 256
+compiled_queries = {}
+
+
+class QueryCompiler:
+    def __init__(self, assignments):
+        self.assignments = assignments
+        self.sources = []
+        self.params = []
+        self.lines = []
+        self.vars = 0
+
+    def new_var(self, prefix):
+        self.vars += 1
+        return f"{prefix}{self.vars}"
+
+    def add_source(self, relation):
+        self.sources.append(relation.tuples)
+        return f"s{len(self.sources) - 1}"
+
+    def add_param(self, value):
+        self.params.append(value)
+        return f"p{len(self.params) - 1}"
+
+    def emit(self, indent, line):
+        self.lines.append("    " * indent + line)
+
+    # NOTE: Loops check the query's limits themselves, a selective loop may run for
+    # a long time without yielding a row to the consumer
+    def emit_checkpoint(self, indent, count):
+        self.emit(indent, f"{count} += 1")
+        self.emit(indent, f"if {count} % {CHECKPOINT_INTERVAL} == 0:")
+        self.emit(indent + 1, "checkpoint()")
+
+    # NOTE: A failed attempt is rolled back, so the generated code for a query shape does
+    # not depend on how far planning got and dropped relations are not kept alive
+    def plan(self, node):
+        sources, params, vars = len(self.sources), len(self.params), self.vars
+        try:
+            return self.plan_node(node)
+        except UnsupportedNodeException:
+            del self.sources[sources:]
+            del self.params[params:]
+            self.vars = vars
+        relation_type = check_types(node, self.assignments)
+        if not isinstance(relation_type, RelationType):
+            raise UnsupportedNodeException
+        relation = node.evaluate(self.assignments)
+        return ScanPlan(self, relation, relation_type.column_types)
+
+    def plan_node(self, node):
+        if isinstance(node, Identifier):
+            relation = node.evaluate(self.assignments)
+            return ScanPlan(self, relation, relation.schema())
+        if isinstance(node, UnaryExpression):
+            match node.operator:
+                case ("select", condition):
+                    child = self.plan(node.expression)
+                    code, type = self.condition(condition, child.columns)
+                    if type != bool:
+                        raise UnsupportedNodeException
+                    return FilterPlan(child, code)
+                case ("project", column_names):
+                    child = self.plan(node.expression)
+                    columns = []
+                    for name in column_names:
+                        columns.append(find_column(child.columns, name))
+                    return ProjectPlan(child, columns)
+        if isinstance(node, BinaryExpression):
+            match node.operator:
+                case "join":
+                    return self.plan_natural_join(node)
+                case "semi_join":
+                    return self.plan_semi_join(node, anti=False)
+                case "anti_join":
+                    return self.plan_semi_join(node, anti=True)
+                case ("theta_join", condition):
+                    return self.plan_theta_join(node, condition)
+        raise UnsupportedNodeException
+
+    def plan_natural_join(self, node):
+        probe = self.plan(node.left)
+        build = self.plan(node.right)
+        probe_keys = []
+        build_keys = []
+        columns = list(probe.columns)
+        for column in build.columns:
+            try:
+                probe_keys.append(find_column(probe.columns, column.name))
+                build_keys.append(column)
+            except UnsupportedNodeException:
+                columns.append(column)
+        return JoinPlan(probe, build, probe_keys, build_keys, None, columns)
+
+    def plan_semi_join(self, node, anti):
+        probe = self.plan(node.left)
+        build = self.plan(node.right)
+        probe_keys = []
+        build_keys = []
+        for column in probe.columns:
+            try:
+                build_keys.append(find_column(build.columns, column.name))
+                probe_keys.append(column)
+            except UnsupportedNodeException:
+                pass
+        return SemiJoinPlan(probe, build, probe_keys, build_keys, anti)
+
+    def plan_theta_join(self, node, condition):
+        probe = self.plan(node.left)
+        build = self.plan(node.right)
+        if not disjoint_column_names(
+            [column.name for column in probe.columns],
+            [column.name for column in build.columns],
+        ):
+            raise UnsupportedNodeException
+        columns = probe.columns + build.columns
+        nullable = any(column.nullable for column in columns)
+
+        probe_keys = []
+        build_keys = []
+        rest = []
+        for conjunct in conjuncts(condition):
+            code, type = self.condition(conjunct, columns)
+            if type != bool:
+                raise UnsupportedNodeException
+            keys = self.equality_keys(conjunct, probe.columns, build.columns)
+            if keys == None or nullable:
+                rest.append(code)
+                continue
+            probe_keys.append(keys[0])
+            build_keys.append(keys[1])
+
+        code = None
+        if len(rest) > 0:
+            code = " & ".join(rest)
+        return JoinPlan(probe, build, probe_keys, build_keys, code, columns)
+
+    def equality_keys(self, condition, probe_columns, build_columns):
+        if not isinstance(condition, BinaryExpression) or condition.operator != "==":
+            return None
+        if not isinstance(condition.left, Identifier) or not isinstance(
+            condition.right, Identifier
+        ):
+            return None
+        for left, right in [
+            (condition.left, condition.right),
+            (condition.right, condition.left),
+        ]:
+            try:
+                return (
+                    find_column(probe_columns, left),
+                    find_column(build_columns, right),
+                )
+            except UnsupportedNodeException:
+                pass
+        return None
+
+    def condition(self, node, columns):
+        if isinstance(node, Identifier):
+            column = find_column(columns, node)
+            if column.nullable:
+                return f"not_null({column.var})", column.type
+            return column.var, column.type
+        if isinstance(node, IntegerLiteral) or isinstance(node, StringLiteral):
+            return self.add_param(node), value_type(node)
+        if isinstance(node, UnaryExpression):
+            if node.operator == "!":
+                code, type = self.condition(node.expression, columns)
+                if type != bool:
+                    raise UnsupportedNodeException
+                return f"(not {code})", bool
+            if node.operator == "is_null" and isinstance(node.expression, Identifier):
+                return f'({find_column(columns, node.expression).var} == "NULL")', bool
+            raise UnsupportedNodeException
+        if not isinstance(node, BinaryExpression):
+            raise UnsupportedNodeException
+        left, left_type = self.condition(node.left, columns)
+        right, right_type = self.condition(node.right, columns)
+        if node.operator in COMPARISON_OPERATORS:
+            if left_type == bool or right_type == bool:
+                raise UnsupportedNodeException
+            if left_type != None and right_type != None and left_type != right_type:
+                raise UnsupportedNodeException
+            return f"({left} {node.operator} {right})", bool
+        if node.operator in ["&&", "||"]:
+            if left_type != bool or right_type != bool:
+                raise UnsupportedNodeException
+            operator = "&" if node.operator == "&&" else "|"
+            return f"({left} {operator} {right})", bool
+        raise UnsupportedNodeException
+
+    def compile(self, plan):
+        self.emit(0, "def query(sources, params):")
+        for i in range(len(self.sources)):
+            self.emit(1, f"s{i} = sources[{i}]")
+        for i in range(len(self.params)):
+            self.emit(1, f"p{i} = params[{i}]")
+        row = column_vars(plan.columns)
+        plan.produce(self, lambda indent: self.emit(indent, f"yield ({row})"), 1)
+
+        code = "\n".join(self.lines)
+        query = compiled_queries.get(code)
+        if query == None:
+            namespace = {
+                "not_null": not_null,
+                "EvaluationException": EvaluationException,
+                "HashTable": HashTable,
+                "checkpoint": checkpoint,
+                "hash_table_size": hash_table_size,
+                "track": track,
+                "tuples_size": tuples_size,
+            }
+            exec(compile(code, "<query>", "exec"), namespace)
+            query = namespace["query"]
+            if len(compiled_queries) >= COMPILED_QUERY_CACHE_SIZE:
+                compiled_queries.clear()
+            compiled_queries[code] = query
+        return query
+
+
+def find_column(columns, name):
+    for column in reversed(columns):
+        if column.name == name:
+            return column
+    raise UnsupportedNodeException
+
+
+def conjuncts(condition):
+    if isinstance(condition, BinaryExpression) and condition.operator == "&&":
+        return conjuncts(condition.left) + conjuncts(condition.right)
+    return [condition]
+
+
+def is_compilable(syntax_tree):
+    if not isinstance(syntax_tree, (UnaryExpression, BinaryExpression)):
+        return False
+    match syntax_tree.operator:
+        case ("select", _) | ("project", _) | ("theta_join", _):
+            return True
+        case "join" | "semi_join" | "anti_join":
+            return True
+    return False
+
+
+# NOTE: Join chains are left to the interpreter so its joins can pass Bloom filters
+def use_compiler(syntax_tree):
+    if not COMPILE_QUERIES or not is_compilable(syntax_tree):
+        return False
+    return not BLOOM_FILTERS or not contains_join_chain(syntax_tree)
+
+
+def compile_stream(syntax_tree, assignments):
+    compiler = QueryCompiler(assignments)
+    plan = compiler.plan(syntax_tree)
+    if isinstance(plan, ScanPlan):
+        relation = plan.relation
+        column_types = tuple(
+            ColumnType(column.type, column.nullable) for column in plan.columns
+        )
+        return relation.column_names, column_types, iter(relation.tuples)
+    query = compiler.compile(plan)
+    column_names = tuple(column.name for column in plan.columns)
+    column_types = tuple(
+        ColumnType(column.type, column.nullable) for column in plan.columns
+    )
+    return column_names, column_types, query(compiler.sources, compiler.params)
+
+
+def run_compiled(syntax_tree, assignments):
+    column_names, column_types, rows = compile_stream(syntax_tree, assignments)
+    try:
+        tuples = list(checked_rows(rows, len(column_names)))
+    except TypeError:
+        raise EvaluationException("Type mismatch in condition")
+    relation = Relation(column_names, tuples, column_types)
+    return track_relation(relation, new_tuples=True)
+
+
+# NOTE: Compiled queries produce their tuples lazily, so consumers can stop early
+def stream_tuples(syntax_tree, assignments):
+    if use_compiler(syntax_tree):
+        return compile_stream(syntax_tree, assignments)
+    relation_type = check_types(syntax_tree, assignments)
+    if not isinstance(relation_type, RelationType):
+        raise EvaluationException(f"Expected a relation but got type: {relation_type}")
+    relation = syntax_tree.evaluate(assignments)
+    return relation.column_names, relation_type.column_types, iter(relation.tuples)
 
 
 class ParseException(Exception):
     pass
 
 
+class IncompleteInputException(ParseException):
+    pass
+
+
+# NOTE: A token list that asks read_line() for more input instead of input()
+class TokenStream(list):
+    def __init__(self, tokens, read_line):
+        super().__init__(tokens)
+        self.read_line = read_line
+
+
+def read_line(tokens):
+    if isinstance(tokens, TokenStream):
+        return tokens.read_line()
+    return input()
+
+
+def end_of_input():
+    raise IncompleteInputException("Unexpected end of input")
+
+
 def parse_input(tokens):
+    if len(tokens) >= 1 and tokens[0] in ["insert", "delete"]:
+        statement = parse_statement(tokens)
+        if len(tokens) != 0:
+            raise ParseException(f"Extraneous tokens after statement '{statement}'")
+        return statement
     if len(tokens) >= 2:
         if tokens[1] == "{":
             relation = parse_relation(tokens)
@@ -412,11 +1930,38 @@ def parse_relation(tokens):
 
     if parse_token(tokens, "}") == None:
         raise ParseException("Expected '}' after tuples")
-    relation = Relation(column_names, tuples)
-    global_assignments[relation_name] = relation
+    column_types = infer_column_types(column_names, tuples[:1])
+    relation = Relation(column_names, tuples, column_types)
+    global_catalog.publish(relation_name, relation)
     return relation_name
 
 
+def parse_statement(tokens):
+    operator = parse_tokens(tokens, ["insert", "delete"])
+    preposition = "into" if operator == "insert" else "from"
+    if parse_token(tokens, preposition) == None:
+        raise ParseException(f"Expected '{preposition}' after '{operator}'")
+    relation_name = parse_identifier(tokens)
+    if relation_name == None:
+        raise ParseException(f"Expected an identifier after '{preposition}'")
+
+    if parse_token(tokens, "{") == None:
+        query = parse_binary_expression(tokens)
+        if query == None:
+            raise ParseException(f"Expected tuples or a query after '{relation_name}'")
+        return Statement(operator, relation_name, query)
+
+    tuples = []
+    while True:
+        tup = parse_tuple(tokens)
+        if tup == None:
+            break
+        tuples.append(tup)
+    if parse_token(tokens, "}") == None:
+        raise ParseException("Expected '}' after tuples")
+    return Statement(operator, relation_name, tuples)
+
+
 def parse_binary_expression(tokens):
     left = parse_unary_expression(tokens)
     if left == None:
@@ -472,6 +2017,8 @@ SIMPLE_BINARY_OPERATORS = [
     "intersect",
     "minus",
     "join",
+    "semi_join",
+    "anti_join",
 ]
 
 
@@ -510,9 +2057,33 @@ def parse_unary_operator(tokens):
         if column_names == None:
             raise ParseException("Expected column names after 'project'")
         return ("project", column_names)
+    if parse_token(tokens, "order_by", can_end=True) != None:
+        sort_keys = parse_sort_keys(tokens)
+        if sort_keys == None:
+            raise ParseException("Expected column names after 'order_by'")
+        return ("order_by", sort_keys)
+    if parse_token(tokens, "limit", can_end=True) != None:
+        count = parse_literal(tokens)
+        if not isinstance(count, IntegerLiteral) or count < 0:
+            raise ParseException("Expected a non-negative integer after 'limit'")
+        return ("limit", count)
     return None
 
 
+def parse_sort_keys(tokens):
+    sort_keys = ()
+    while True:
+        name = parse_identifier(tokens)
+        if name == None:
+            if len(sort_keys) == 0:
+                return None
+            raise ParseException("Expected a column name after ','")
+        descending = parse_token(tokens, "desc", can_end=True) != None
+        sort_keys += ((name, descending),)
+        if parse_token(tokens, ",", can_end=True) == None:
+            return sort_keys
+
+
 def parse_column_names(tokens):
     column_names = (parse_identifier(tokens),)
     if column_names[0] == None:
@@ -539,7 +2110,7 @@ def parse_tuple(tokens):
 
 def parse_identifier(tokens):
     if len(tokens) == 0:
-        tokens.extend(tokenize(input()))
+        tokens.extend(tokenize(read_line(tokens)))
         if len(tokens) == 0:
             return None
     if not isinstance(tokens[0], Identifier):
@@ -549,7 +2120,7 @@ def parse_identifier(tokens):
 
 def parse_literal(tokens):
     if len(tokens) == 0:
-        tokens.extend(tokenize(input()))
+        tokens.extend(tokenize(read_line(tokens)))
         if len(tokens) == 0:
             return None
     if not isinstance(tokens[0], IntegerLiteral) and not isinstance(
@@ -563,7 +2134,7 @@ def parse_tokens(tokens, candidates, can_end=False):
     if can_end and len(tokens) == 0:
         return None
     if not can_end and len(tokens) == 0:
-        tokens.extend(tokenize(input()))
+        tokens.extend(tokenize(read_line(tokens)))
         if len(tokens) == 0:
             return None
     if tokens[0] not in candidates:
@@ -575,7 +2146,7 @@ def parse_token(tokens, token, can_end=False):
     if can_end and len(tokens) == 0:
         return None
     if not can_end and len(tokens) == 0:
-        tokens.extend(tokenize(input()))
+        tokens.extend(tokenize(read_line(tokens)))
         if len(tokens) == 0:
             return None
     if tokens[0] != token:
@@ -590,11 +2161,20 @@ KEYWORDS = [
     "intersect",
     "minus",
     "join",
+    "semi_join",
+    "anti_join",
     "theta_join",
     "left_join",
     "right_join",
     "full_join",
     "is_null",
+    "order_by",
+    "limit",
+    "desc",
+    "insert",
+    "into",
+    "delete",
+    "from",
 ]
 
 
@@ -692,7 +2272,7 @@ def add_debug_relations():
         }
     """
         )
-    ).evaluate(global_assignments)
+    )
     parse_input(
         tokenize(
             """
@@ -703,7 +2283,7 @@ def add_debug_relations():
         }
     """
         )
-    ).evaluate(global_assignments)
+    )
     parse_input(
         tokenize(
             """
@@ -715,7 +2295,7 @@ def add_debug_relations():
         }
     """
         )
-    ).evaluate(global_assignments)
+    )
     parse_input(
         tokenize(
             """
@@ -727,10 +2307,10 @@ def add_debug_relations():
         }
     """
         )
-    ).evaluate(global_assignments)
+    )
 
 
-global_assignments = {}
+global_catalog = Catalog()
 
 
 def repl():
@@ -755,15 +2335,550 @@ def repl():
         if debug_mode:
             print(f"Syntax tree: {syntax_tree}")
 
+        tracker = QueryTracker()
+        try:
+            with global_catalog.snapshot() as snapshot:
+                print(execute(syntax_tree, snapshot, tracker))
+        except EvaluationException as exception:
+            print(f"Could not evaluate query due to exception: {exception}")
+            continue
+        except KeyboardInterrupt:
+            print("Query cancelled")
+            continue
+        if debug_mode:
+            eliminated = bloom_filter_rows_eliminated(syntax_tree)
+            print(f"Rows eliminated by Bloom filters: {eliminated}")
+            print(f"Peak memory: {tracker.peak_bytes} bytes")
+
+
+def execute(syntax_tree, assignments, tracker=None):
+    if tracker == None:
+        tracker = QueryTracker()
+    with tracker:
+        if isinstance(syntax_tree, Statement):
+            return syntax_tree.evaluate(assignments)
+        return evaluate_query(syntax_tree, assignments)
+
+
+def evaluate_query(syntax_tree, assignments):
+    check_types(syntax_tree, assignments)
+    syntax_tree = optimize(syntax_tree, assignments)
+    if use_compiler(syntax_tree):
+        return run_compiled(syntax_tree, assignments)
+    return syntax_tree.evaluate(assignments)
+
+
+class SharingReport:
+    def __init__(self, scans, scans_saved, evaluations, evaluations_saved):
+        self.scans = scans
+        self.scans_saved = scans_saved
+        self.evaluations = evaluations
+        self.evaluations_saved = evaluations_saved
+
+    def __repr__(self):
+        return (
+            f"Saved {self.scans_saved} of {self.scans} scans and "
+            f"{self.evaluations_saved} of {self.evaluations} operator evaluations"
+        )
+
+
+def relational_children(node):
+    if isinstance(node, UnaryExpression):
+        return [node.expression]
+    if isinstance(node, BinaryExpression):
+        return [node.left, node.right]
+    return []
+
+
+def count_evaluations(node):
+    if isinstance(node, (UnaryExpression, BinaryExpression)):
+        return 1 + sum(count_evaluations(child) for child in relational_children(node))
+    return 0
+
+
+# NOTE: Placeholders for shared results start with $, which the lexer cannot produce
+def is_base_relation(node):
+    return isinstance(node, Identifier) and not node.startswith("$")
+
+
+def count_scans(node):
+    if is_base_relation(node):
+        return 1
+    return sum(count_scans(child) for child in relational_children(node))
+
+
+def replace_nodes(node, replacements):
+    if id(node) in replacements:
+        return replacements[id(node)]
+    if isinstance(node, UnaryExpression):
+        node.expression = replace_nodes(node.expression, replacements)
+    elif isinstance(node, BinaryExpression):
+        node.left = replace_nodes(node.left, replacements)
+        node.right = replace_nodes(node.right, replacements)
+    return node
+
+
+def compiled_shared_scan(relation, conditions, assignments):
+    if not COMPILE_QUERIES:
+        raise UnsupportedNodeException
+    compiler = QueryCompiler(assignments)
+    scan = ScanPlan(compiler, relation, relation.schema())
+    filters = []
+    outputs = []
+    for condition in conditions:
+        code, type = compiler.condition(condition, scan.columns)
+        if type != bool:
+            raise UnsupportedNodeException
+        outputs.append([])
+        filters.append((code, compiler.add_param(outputs[-1])))
+    query = compiler.compile(SharedScanPlan(scan, filters))
+    try:
+        query(compiler.sources, compiler.params)
+    except TypeError:
+        raise EvaluationException("Type mismatch in condition")
+    return outputs
+
+
+# NOTE: Used when a condition cannot be compiled, still a single pass over the tuples
+def interpreted_shared_scan(relation, conditions):
+    outputs = [[] for _ in conditions]
+    assignments = {}
+    for row, tup in enumerate(relation.tuples):
+        if row % CHECKPOINT_INTERVAL == 0:
+            checkpoint(tuples_size(sum(len(tuples) for tuples in outputs)))
+        for i, name in enumerate(relation.column_names):
+            assignments[name] = tup[i]
+        for condition, tuples in zip(conditions, outputs):
+            if condition.evaluate(assignments):
+                tuples.append(tup)
+    return outputs
+
+
+def shared_scan(relation, conditions, assignments):
+    checkpoint()
+    try:
+        outputs = compiled_shared_scan(relation, conditions, assignments)
+    except UnsupportedNodeException:
+        outputs = interpreted_shared_scan(relation, conditions)
+    return [
+        track_relation(Relation(relation.column_names, tuples, relation.schema()))
+        for tuples in outputs
+    ]
+
+
+# NOTE: Evaluates several queries together: identical subtrees are evaluated once and
+# selects over the same base relation share one scan of it. Shared results are bound
+# to placeholders, so the batch is also the assignments the rewritten queries use
+class QueryBatch:
+    def __init__(self, queries, assignments):
+        self.assignments = assignments
+        self.results = {}
+        self.placeholders = {}
+        self.definitions = []
+        self.counts = {}
+        self.names = 0
+        self.trees = []
+        for syntax_tree in queries:
+            if isinstance(syntax_tree, Statement):
+                raise EvaluationException("Statements cannot be evaluated in a batch")
+            check_types(syntax_tree, assignments)
+            self.trees.append(optimize(syntax_tree, assignments))
+        self.scans = sum(count_scans(tree) for tree in self.trees)
+        self.evaluations = sum(count_evaluations(tree) for tree in self.trees)
+        self.shared_scans = 0
+        self.shared_selects = 0
+
+    def __getitem__(self, name):
+        if name in self.results:
+            return self.results[name]
+        return self.assignments[name]
+
+    def new_placeholder(self):
+        self.names += 1
+        return Identifier(f"${self.names}")
+
+    # NOTE: Only subtrees that produce relations are counted, scalar results such as
+    # the value of 1 == 1 are not worth sharing and are not relations to scan
+    def count_subtrees(self, node):
+        if isinstance(node, (UnaryExpression, BinaryExpression)):
+            key = repr(node)
+            if key not in self.counts:
+                relation_type = check_types(node, self.assignments)
+                if not isinstance(relation_type, RelationType):
+                    return
+                self.counts[key] = 0
+            self.counts[key] += 1
+            for child in relational_children(node):
+                self.count_subtrees(child)
+
+    # NOTE: The first occurrence of a repeated subtree becomes its definition,
+    # definitions are listed before the definitions that use them
+    def share_subtrees(self, node):
+        if not isinstance(node, (UnaryExpression, BinaryExpression)):
+            return node
+        key = repr(node)
+        if key in self.placeholders:
+            return self.placeholders[key]
+        if isinstance(node, UnaryExpression):
+            node.expression = self.share_subtrees(node.expression)
+        else:
+            node.left = self.share_subtrees(node.left)
+            node.right = self.share_subtrees(node.right)
+        if self.counts.get(key, 0) < 2:
+            return node
+        placeholder = self.new_placeholder()
+        self.placeholders[key] = placeholder
+        self.definitions.append((placeholder, node))
+        return placeholder
+
+    def find_base_selects(self, node, selects):
+        if isinstance(node, UnaryExpression) and is_base_relation(node.expression):
+            match node.operator:
+                case ("select", _):
+                    selects.setdefault(node.expression, []).append(node)
+                    return
+        for child in relational_children(node):
+            self.find_base_selects(child, selects)
+
+    def share_scans(self):
+        selects = {}
+        for tree in self.all_trees():
+            self.find_base_selects(tree, selects)
+        replacements = {}
+        for name, nodes in selects.items():
+            if len(nodes) < 2:
+                continue
+            conditions = [node.operator[1] for node in nodes]
+            relations = shared_scan(
+                name.evaluate(self.assignments), conditions, self.assignments
+            )
+            for node, relation in zip(nodes, relations):
+                placeholder = self.new_placeholder()
+                self.results[placeholder] = relation
+                replacements[id(node)] = placeholder
+            self.shared_scans += 1
+            self.shared_selects += len(nodes)
+        self.definitions = [
+            (placeholder, replace_nodes(tree, replacements))
+            for placeholder, tree in self.definitions
+        ]
+        self.trees = [replace_nodes(tree, replacements) for tree in self.trees]
+
+    def all_trees(self):
+        return [tree for _, tree in self.definitions] + self.trees
+
+    def execute(self):
+        for tree in self.trees:
+            self.count_subtrees(tree)
+        self.trees = [self.share_subtrees(tree) for tree in self.trees]
+        self.share_scans()
+
+        for placeholder, tree in self.definitions:
+            relation_type = check_types(tree, self)
+            relation = evaluate_query(tree, self)
+            if relation.column_types == None:
+                relation.column_types = relation_type.column_types
+            self.results[placeholder] = relation
+        return [evaluate_query(tree, self) for tree in self.trees]
+
+    def report(self):
+        scans = self.shared_scans
+        evaluations = self.shared_selects
+        for tree in self.all_trees():
+            scans += count_scans(tree)
+            evaluations += count_evaluations(tree)
+        return SharingReport(
+            self.scans,
+            self.scans - scans,
+            self.evaluations,
+            self.evaluations - evaluations,
+        )
+
+
+def execute_queries(queries, assignments, tracker=None):
+    if tracker == None:
+        tracker = QueryTracker()
+    with tracker:
+        batch = QueryBatch(queries, assignments)
+        results = batch.execute()
+    return results, batch.report()
+
+
+def run_batch(text):
+    lines = enumerate(text.splitlines(), 1)
+
+    def next_line():
+        for _, line in lines:
+            return line
+        end_of_input()
+
+    statements = 0
+    failures = 0
+    total_time = 0.0
+    for line_number, line in lines:
+        if line.strip() == "":
+            continue
+        statements += 1
+        start = time.perf_counter()
+        syntax_tree = None
+        tracker = QueryTracker()
         try:
-            print(syntax_tree.evaluate(global_assignments))
+            syntax_tree = parse_input(TokenStream(tokenize(line), next_line))
+            with global_catalog.snapshot() as snapshot:
+                print(execute(syntax_tree, snapshot, tracker))
+        except TokenizeException as exception:
+            failures += 1
+            print(f"Could not tokenize query due to exception: {exception}")
+        except ParseException as exception:
+            failures += 1
+            print(f"Could not parse query due to exception: {exception}")
         except EvaluationException as exception:
+            failures += 1
             print(f"Could not evaluate query due to exception: {exception}")
+        elapsed = time.perf_counter() - start
+        total_time += elapsed
+        report = f"Statement {statements} (line {line_number}): {elapsed * 1000:.3f} ms"
+        report += f", peak memory {tracker.peak_bytes} bytes"
+        eliminated = bloom_filter_rows_eliminated(syntax_tree)
+        if eliminated > 0:
+            report += f", {eliminated} rows eliminated by Bloom filters"
+        print(report)
+
+    print(
+        f"Executed {statements} statements ({failures} failed) in {total_time * 1000:.3f} ms"
+    )
+    return statements, failures
+
+
+def run_script():
+    if "-d" in sys.argv or "--debug" in sys.argv:
+        add_debug_relations()
+    path = get_option(["-f", "--file"])
+    if path != None:
+        with open(path) as file:
+            text = file.read()
+    else:
+        text = sys.stdin.read()
+    _, failures = run_batch(text)
+    if failures > 0:
+        sys.exit(1)
+
+
+def result_lines(result):
+    if isinstance(result, Relation):
+        return result.lines()
+    return [str(result)]
+
+
+SIZE_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+# NOTE: Accepts a number of bytes with an optional K, M or G suffix, e.g. 512M
+def parse_size(text):
+    if text == None or isinstance(text, int):
+        return text
+    multiplier = SIZE_SUFFIXES.get(text[-1:].upper())
+    if multiplier == None:
+        return int(text)
+    return int(float(text[:-1]) * multiplier)
+
+
+def get_option(names, default=None):
+    for i, arg in enumerate(sys.argv[:-1]):
+        if arg in names:
+            return sys.argv[i + 1]
+    return default
+
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 7878
+SERVER_WORKERS = 4
+SERVER_CHUNK_LINES = 256
+
+
+def next_chunk(lines):
+    return list(itertools.islice(lines, SERVER_CHUNK_LINES))
+
+
+# NOTE: Responses end with an empty line (an empty response asks for more input)
+async def send_lines(writer, lines, executor):
+    loop = asyncio.get_running_loop()
+    lines = iter(lines)
+    while True:
+        chunk = await loop.run_in_executor(executor, next_chunk, lines)
+        if len(chunk) == 0:
+            break
+        writer.write(("\n".join(chunk) + "\n").encode())
+        await writer.drain()
+    writer.write(b"\n")
+    await writer.drain()
+
+
+def parse_request(line, read_line):
+    return parse_input(TokenStream(tokenize(line), read_line))
+
+
+# NOTE: Each connection parses on its own thread, which asks the event loop for each
+# further line. Every line is tokenized once, relations are published off the event
+# loop and clients in the middle of a request never hold one of the executor's workers
+async def handle_client(reader, writer, executor):
+    loop = asyncio.get_running_loop()
+    parser = ThreadPoolExecutor(max_workers=1)
+    waiting = set()
+
+    async def next_line():
+        writer.write(b"\n")
+        await writer.drain()
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed in the middle of a query")
+        return line.decode()
+
+    def read_line():
+        future = asyncio.run_coroutine_threadsafe(next_line(), loop)
+        waiting.add(future)
+        try:
+            return future.result()
+        finally:
+            waiting.discard(future)
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            try:
+                syntax_tree = await loop.run_in_executor(
+                    parser, parse_request, line.decode(), read_line
+                )
+            except TokenizeException as exception:
+                message = f"Could not tokenize query due to exception: {exception}"
+                await send_lines(writer, [message], executor)
+                continue
+            except ParseException as exception:
+                message = f"Could not parse query due to exception: {exception}"
+                await send_lines(writer, [message], executor)
+                continue
+
+            with global_catalog.snapshot() as snapshot:
+                try:
+                    result = await loop.run_in_executor(
+                        executor, execute, syntax_tree, snapshot
+                    )
+                except EvaluationException as exception:
+                    message = f"Could not evaluate query due to exception: {exception}"
+                    await send_lines(writer, [message], executor)
+                    continue
+                await send_lines(writer, result_lines(result), executor)
+    except ConnectionError:
+        pass
+    finally:
+        for future in list(waiting):
+            future.cancel()
+        parser.shutdown(wait=False)
+        writer.close()
+
+
+async def start_server(executor, host=SERVER_HOST, port=SERVER_PORT, path=None):
+    def on_connect(reader, writer):
+        return handle_client(reader, writer, executor)
+
+    if path != None:
+        return await asyncio.start_unix_server(on_connect, path=path)
+    return await asyncio.start_server(on_connect, host, port)
+
+
+async def run_server(host, port, path):
+    with ThreadPoolExecutor(max_workers=SERVER_WORKERS) as executor:
+        server = await start_server(executor, host, port, path)
+        for sock in server.sockets:
+            print(f"Listening on {sock.getsockname()}")
+        async with server:
+            await server.serve_forever()
+
+
+def serve():
+    if "-d" in sys.argv or "--debug" in sys.argv:
+        add_debug_relations()
+    host = get_option(["--host"], SERVER_HOST)
+    port = int(get_option(["--port"], SERVER_PORT))
+    path = get_option(["--socket"])
+    asyncio.run(run_server(host, port, path))
+
+
+async def request(reader, writer, line):
+    writer.write((line + "\n").encode())
+    await writer.drain()
+    lines = []
+    while True:
+        response = await reader.readline()
+        if not response:
+            raise ConnectionError("Server closed the connection")
+        response = response.decode().rstrip("\n")
+        if response == "":
+            return lines
+        lines.append(response)
+
+
+async def open_connection(host=SERVER_HOST, port=SERVER_PORT, path=None):
+    if path != None:
+        return await asyncio.open_unix_connection(path)
+    return await asyncio.open_connection(host, port)
+
+
+async def run_client(host, port, path):
+    reader, writer = await open_connection(host, port, path)
+    prompt = ": "
+    try:
+        while True:
+            lines = await request(reader, writer, input(prompt))
+            if len(lines) == 0:
+                prompt = ""
+                continue
+            prompt = ": "
+            print("\n".join(lines))
+    finally:
+        writer.close()
+
+
+def connect():
+    host = get_option(["--host"], SERVER_HOST)
+    port = int(get_option(["--port"], SERVER_PORT))
+    path = get_option(["--socket"])
+    asyncio.run(run_client(host, port, path))
 
 
 def main():
+    global COMPILE_QUERIES, BLOOM_FILTERS
+    global BLOOM_FILTER_FALSE_POSITIVE_RATE, BLOOM_FILTER_MAX_BITS
+    global QUERY_MEMORY_LIMIT, GLOBAL_MEMORY_LIMIT, QUERY_TIMEOUT
+    if "--no-compile" in sys.argv:
+        COMPILE_QUERIES = False
+    if "--no-bloom-filters" in sys.argv:
+        BLOOM_FILTERS = False
+    BLOOM_FILTER_FALSE_POSITIVE_RATE = float(
+        get_option(["--bloom-filter-rate"], BLOOM_FILTER_FALSE_POSITIVE_RATE)
+    )
+    BLOOM_FILTER_MAX_BITS = int(
+        get_option(["--bloom-filter-bits"], BLOOM_FILTER_MAX_BITS)
+    )
+    QUERY_MEMORY_LIMIT = parse_size(get_option(["--memory-limit"], QUERY_MEMORY_LIMIT))
+    GLOBAL_MEMORY_LIMIT = parse_size(
+        get_option(["--global-memory-limit"], GLOBAL_MEMORY_LIMIT)
+    )
+    timeout = get_option(["--timeout"])
+    if timeout != None:
+        QUERY_TIMEOUT = float(timeout)
     try:
-        repl()
+        if "-s" in sys.argv or "--server" in sys.argv:
+            serve()
+        elif "-c" in sys.argv or "--connect" in sys.argv:
+            connect()
+        elif "-f" in sys.argv or "--file" in sys.argv or not sys.stdin.isatty():
+            run_script()
+        else:
+            repl()
     except (KeyboardInterrupt, EOFError):
         pass
 
@@ -1,3 +1,8 @@
+import asyncio
+import contextlib
+import io
+import sys
+
 from main import *
 
 
@@ -28,6 +33,46 @@ def run_set_operator_tests():
     assert same(intersect(c, c), c)
 
 
+def run_semi_join_tests():
+    a = Relation(("Name", "DeptID"), [])
+    b = Relation(("DeptID", "Manager"), [])
+    with_department = Relation(("Name", "DeptID"), [])
+    without_department = Relation(("Name", "DeptID"), [])
+    for i in range(100):
+        t = (StringLiteral(f"e{i}"), IntegerLiteral(i % 20))
+        a.tuples.append(t)
+        if i % 20 < 10:
+            with_department.tuples.append(t)
+        else:
+            without_department.tuples.append(t)
+    for i in range(10):
+        b.tuples.append((IntegerLiteral(i), StringLiteral(f"m{i}")))
+        b.tuples.append((IntegerLiteral(i), StringLiteral(f"n{i}")))
+
+    assert same(semi_join(a, b), with_department)
+    assert same(semi_join(a, b, anti=True), without_department)
+    assert same(semi_join(a, a), a)
+    assert same(semi_join(a, with_department, anti=True), without_department)
+
+    assignments = {"A": a, "B": b, "C": with_department}
+    for query, rewritten in [
+        ("project Name (A join B)", "project Name (A join B)"),
+        ("project Manager (A join B)", "project Manager (A join B)"),
+        ("A intersect C", "A semi_join C"),
+        (
+            "(project DeptID A) minus (project DeptID B)",
+            "(project DeptID A) anti_join (project DeptID B)",
+        ),
+    ]:
+        syntax_tree = parse_input(tokenize(query))
+        expected = syntax_tree.evaluate(assignments)
+        check_types(syntax_tree, assignments)
+        syntax_tree = optimize(syntax_tree, assignments)
+        assert repr(syntax_tree) == repr(parse_input(tokenize(rewritten)))
+        assert syntax_tree.evaluate(assignments).tuples == expected.tuples
+        assert run_compiled(syntax_tree, assignments).tuples == expected.tuples
+
+
 def run_unary_operator_tests():
     a = Relation(("ID", "Department", "Manager"), [])
     b = Relation(("ID", "Department", "Manager"), [])
@@ -126,9 +171,492 @@ def run_join_tests():
 
 def run_operator_tests():
     run_set_operator_tests()
+    run_semi_join_tests()
     run_unary_operator_tests()
     run_join_tests()
 
 
+def run_server_tests():
+    async def run():
+        with ThreadPoolExecutor() as executor:
+            server = await start_server(executor, port=0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await open_connection(port=port)
+
+            assert await request(reader, writer, "ServerTest { ID, Name") == []
+            assert await request(reader, writer, '1, "a"') == []
+            lines = await request(reader, writer, '2, "b" }')
+            assert len(lines) == 6
+            with global_catalog.snapshot() as snapshot:
+                assert lines == str(snapshot["ServerTest"]).split("\n")
+
+            lines = await request(reader, writer, "select ID > 1 ServerTest")
+            assert lines[3] == '| 2  | "b"  |'
+            lines = await request(reader, writer, "Unknown")
+            assert lines[0].startswith("Could not evaluate query")
+            assert await request(reader, writer, "project Name (") == []
+            lines = await request(reader, writer, "ServerTest )")
+            assert lines[3] == '| "a"  |'
+            assert await request(reader, writer, "ServerTest2 { ID") == []
+            lines = await request(reader, writer, "1 }}")
+            assert lines[0].startswith("Could not parse query")
+
+            other_reader, other_writer = await open_connection(port=port)
+            assert await request(other_reader, other_writer, "project ID (") == []
+            other_writer.close()
+            await other_writer.wait_closed()
+            lines = await request(reader, writer, "select ID > 1 ServerTest")
+            assert lines[3] == '| 2  | "b"  |'
+
+            writer.close()
+            await writer.wait_closed()
+            await asyncio.sleep(0.1)
+            server.close()
+            await server.wait_closed()
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            server = await start_server(executor, port=0)
+            port = server.sockets[0].getsockname()[1]
+            idle = [await open_connection(port=port) for _ in range(3)]
+            for reader, writer in idle:
+                assert await request(reader, writer, "project ID (") == []
+
+            reader, writer = await open_connection(port=port)
+            lines = await asyncio.wait_for(request(reader, writer, "1 == 1"), 3)
+            assert lines == ["True"]
+            server.close()
+            for _, idle_writer in idle + [(reader, writer)]:
+                idle_writer.close()
+            await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+
+
+def run_batch_tests():
+    script = """
+    BatchTest { ID, Name
+        1, "a"
+
+        2, "b"
+    }
+    select ID > 1
+        BatchTest
+    select Missing > 1 BatchTest
+    project ID (
+    """
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        statements, failures = run_batch(script)
+    assert (statements, failures) == (4, 2)
+    lines = output.getvalue().split("\n")
+    assert '| 2  | "b"  |' in lines
+    assert "Statement 2 (line 7): " in output.getvalue()
+    assert "Could not parse query due to exception: Unexpected end of input" in lines
+    assert lines[-2].startswith("Executed 4 statements (2 failed) in ")
+
+
+def run_compiler_tests():
+    employees = Relation(("Name", "Age", "DeptID"), [])
+    departments = Relation(("DeptID", "Manager"), [])
+    budgets = Relation(("ID", "Budget"), [])
+    for i in range(100):
+        t = (StringLiteral(f"e{i}"), IntegerLiteral(20 + i % 40), IntegerLiteral(i % 7))
+        employees.tuples.append(t)
+    for i in range(5):
+        departments.tuples.append((IntegerLiteral(i), StringLiteral(f"m{i}")))
+        budgets.tuples.append((IntegerLiteral(i), IntegerLiteral(i * 10)))
+    assignments = {
+        "Employees": employees,
+        "Departments": departments,
+        "Budgets": budgets,
+    }
+
+    queries = [
+        "select Age > 30 Employees",
+        "project Name,Manager (select Age > 30 (Employees join Departments))",
+        "Employees theta_join (DeptID == ID) && (Age < 40) Budgets",
+        "Employees theta_join Age < Budget Budgets",
+        'select !(Age > 30) || (Manager == "m1") (Employees join Departments)',
+        "select is_null ID (Employees left_join DeptID == ID Budgets)",
+    ]
+    for query in queries:
+        syntax_tree = parse_input(tokenize(query))
+        compiled = run_compiled(syntax_tree, assignments)
+        interpreted = syntax_tree.evaluate(assignments)
+        assert compiled.column_names == interpreted.column_names
+        assert compiled.tuples == interpreted.tuples
+
+    syntax_tree = parse_input(
+        tokenize("select Budget > 10 (Employees left_join DeptID == ID Budgets)")
+    )
+    for evaluate in [run_compiled, UnaryExpression.evaluate]:
+        try:
+            evaluate(syntax_tree, assignments)
+            assert False
+        except EvaluationException:
+            pass
+
+    compiled_queries.clear()
+    run_compiled(parse_input(tokenize("select Age > 30 Employees")), assignments)
+    run_compiled(parse_input(tokenize("select Age > 50 Employees")), assignments)
+    assert len(compiled_queries) == 1
+
+    query = "project Name (select is_null (Age > 1) (Employees join Departments))"
+    syntax_tree = parse_input(tokenize(query))
+    check_types(syntax_tree, assignments)
+    compiler = QueryCompiler(assignments)
+    compiler.compile(compiler.plan(syntax_tree))
+    assert len(compiler.sources) == 1
+    expected = parse_input(tokenize(query)).evaluate(assignments)
+    assert run_compiled(syntax_tree, assignments).tuples == expected.tuples
+
+
+def run_type_check_tests():
+    employees = Relation(("Name", "Age"), [])
+    departments = Relation(("DeptName", "Manager"), [])
+    for i in range(10):
+        employees.tuples.append((StringLiteral(f'"e{i}"'), IntegerLiteral(i)))
+    departments.tuples.append((StringLiteral("e1"), StringLiteral("m1")))
+    assignments = {
+        "Employees": employees,
+        "Departments": departments,
+        "Empty": Relation(("Name", "Age"), [], (ColumnType(str), ColumnType(int))),
+    }
+
+    assert employees.schema() == (ColumnType(str), ColumnType(int))
+    syntax_tree = parse_input(
+        tokenize("Employees left_join Name == DeptName Departments")
+    )
+    relation_type = check_types(syntax_tree, assignments)
+    assert relation_type.column_names == ("Name", "Age", "DeptName", "Manager")
+    assert relation_type.column_types == (
+        ColumnType(str),
+        ColumnType(int),
+        ColumnType(str, nullable=True),
+        ColumnType(str, nullable=True),
+    )
+
+    for query in [
+        'select Age > "x" Empty',
+        "select Age Empty",
+        "select Missing == 1 Empty",
+        "project Missing Empty",
+        "Empty union Departments",
+        "Empty theta_join Name == Name Empty",
+        "select is_null Manager (Employees theta_join Name < 3 Departments)",
+    ]:
+        try:
+            check_types(parse_input(tokenize(query)), assignments)
+            assert False
+        except TypeCheckException:
+            pass
+
+    syntax_tree = parse_input(
+        tokenize('select (Age > 3) && !(Name == "e5") (select Name != "e9" Employees)')
+    )
+    check_types(syntax_tree, assignments)
+    condition = syntax_tree.operator[1]
+    assert syntax_tree.type_checked and condition.type_checked
+    assert not condition.nullable
+    assert len(syntax_tree.evaluate(assignments).tuples) == 4
+
+
+def run_order_tests():
+    a = Relation(("ID", "Name"), [], (ColumnType(int), ColumnType(str)))
+    for i in range(1000):
+        a.tuples.append((IntegerLiteral(i * 7 % 100), StringLiteral(f"n{i % 13}")))
+    assignments = {"A": a}
+
+    def evaluate(query):
+        return parse_input(tokenize(query)).evaluate(assignments).tuples
+
+    expected = sorted(a.tuples, key=lambda t: t[0])
+    assert evaluate("order_by ID A") == expected
+    assert evaluate("limit 10 (order_by ID A)") == expected[:10]
+    expected = sorted(a.tuples, key=lambda t: t[0], reverse=True)
+    assert evaluate("limit 10 (order_by ID desc A)") == expected[:10]
+    assert (
+        evaluate("limit 5 (select ID > 50 A)") == [t for t in a.tuples if t[0] > 50][:5]
+    )
+
+    expected = sorted(a.tuples, key=lambda t: (t[1], -t[0]))
+    assert evaluate("order_by Name, ID desc A") == expected
+    assert evaluate("limit 3 (order_by Name, ID desc A)") == expected[:3]
+
+    main_module = sys.modules["main"]
+    main_module.EXTERNAL_SORT_RUN_SIZE = 64
+    try:
+        assert evaluate("order_by Name, ID desc A") == expected
+        assert evaluate("order_by ID desc A") == sorted(
+            a.tuples, key=lambda t: t[0], reverse=True
+        )
+    finally:
+        main_module.EXTERNAL_SORT_RUN_SIZE = 100000
+
+
+def run_catalog_tests():
+    catalog = Catalog()
+    a = Relation(("ID",), [(IntegerLiteral(1),)])
+    b = Relation(("ID",), [(IntegerLiteral(2),)])
+    catalog.publish("A", a)
+
+    with catalog.snapshot() as first:
+        catalog.publish("A", b)
+        catalog.publish("B", b)
+        with catalog.snapshot() as second:
+            assert first["A"] is a
+            assert Identifier("B").evaluate(second) is b
+            try:
+                Identifier("B").evaluate(first)
+                assert False
+            except EvaluationException:
+                pass
+            assert len(catalog.versions) == 2
+        assert len(catalog.versions) == 2
+    assert len(catalog.versions) == 1
+    assert catalog.readers == {}
+
+
+def run_statement_tests():
+    def run(query):
+        syntax_tree = parse_input(tokenize(query))
+        with global_catalog.snapshot() as snapshot:
+            return execute(syntax_tree, snapshot)
+
+    run('Items { ID, Name 1, "a" 2, "b" }')
+    with global_catalog.snapshot() as snapshot:
+        items = snapshot["Items"]
+    tuples = items.tuples
+
+    assert (
+        run('insert into Items { 3, "c" 4, "d" }') == "Inserted 2 tuples into 'Items'"
+    )
+    assert (
+        run("insert into Items select ID < 3 Items") == "Inserted 2 tuples into 'Items'"
+    )
+    with global_catalog.snapshot() as snapshot:
+        assert snapshot["Items"] is items and items.tuples is tuples
+    assert [t[0] for t in tuples] == [1, 2, 3, 4, 1, 2]
+
+    assert (
+        run("delete from Items select ID > 2 Items") == "Deleted 2 tuples from 'Items'"
+    )
+    assert run('delete from Items { 1, "a" }') == "Deleted 2 tuples from 'Items'"
+    assert [t[0] for t in run("Items").tuples] == [2, 2]
+
+    with global_catalog.snapshot() as held:
+        run('insert into Items { 5, "e" }')
+        assert len(held["Items"].tuples) == 2
+    assert [t[0] for t in run("Items").tuples] == [2, 2, 5]
+
+    for query in [
+        "insert into Items { 1 }",
+        'insert into Items { "x", 1 }',
+        "insert into Items project ID Items",
+        "delete from Missing { 1 }",
+    ]:
+        try:
+            run(query)
+            assert False
+        except EvaluationException:
+            pass
+    catalog = Catalog()
+    catalog.publish("Items", Relation(("ID",), [(IntegerLiteral(1),)]))
+    with catalog.snapshot() as snapshot:
+        assert execute(parse_input(tokenize("insert into Items { 2 }")), snapshot) == (
+            "Inserted 1 tuples into 'Items'"
+        )
+    with catalog.snapshot() as snapshot:
+        assert len(snapshot["Items"].tuples) == 2
+    for redefined in [("ID", "Name", "Price"), ()]:
+        catalog.publish("Items", Relation(("ID",), [(IntegerLiteral(1),)]))
+        with catalog.snapshot() as snapshot:
+            catalog.publish("Items", Relation(redefined, []))
+            for query in ["insert into Items { 3 }", "delete from Items { 1 }"]:
+                try:
+                    execute(parse_input(tokenize(query)), snapshot)
+                    assert False
+                except EvaluationException as exception:
+                    assert "redefined" in str(exception)
+        with catalog.snapshot() as snapshot:
+            assert snapshot["Items"].tuples == []
+    try:
+        execute(parse_input(tokenize("insert into Items { 3 }")), {"Items": items})
+        assert False
+    except EvaluationException as exception:
+        assert "snapshot" in str(exception)
+
+    for query in ["insert Items { 1 }", "delete from { 1 }", "insert into Items"]:
+        try:
+            parse_input(TokenStream(tokenize(query), end_of_input))
+            assert False
+        except ParseException:
+            pass
+
+
+def run_bloom_filter_tests():
+    bloom_filter = BloomFilter(("ID",), 1000)
+    for i in range(1000):
+        bloom_filter.add(IntegerLiteral(i))
+    for i in range(1000):
+        assert IntegerLiteral(i) in bloom_filter
+    false_positives = sum(IntegerLiteral(i) in bloom_filter for i in range(1000, 11000))
+    assert false_positives < 300
+
+    a = Relation(("Name", "DeptID"), [], (ColumnType(str), ColumnType(int)))
+    b = Relation(("DeptID", "Floor"), [], (ColumnType(int), ColumnType(int)))
+    c = Relation(("Floor", "Building"), [], (ColumnType(int), ColumnType(str)))
+    for i in range(5):
+        a.tuples.append((StringLiteral(f"e{i}"), IntegerLiteral(i)))
+    for i in range(200):
+        b.tuples.append((IntegerLiteral(i), IntegerLiteral(i % 50)))
+    for i in range(100):
+        c.tuples.append((IntegerLiteral(i), StringLiteral(f"b{i % 7}")))
+    d = Relation(("ID", "Budget"), [], (ColumnType(int), ColumnType(int)))
+    for i in range(300):
+        d.tuples.append((IntegerLiteral(i), IntegerLiteral(i % 50)))
+    assignments = {"A": a, "B": b, "C": c, "D": d}
+    expected_chain = natural_join(a, natural_join(b, c))
+
+    for query in [
+        "A join (B join C)",
+        "A join (select Floor < 3 (B join C))",
+        "project Name, Building (A join (B join C))",
+        "A theta_join DeptID == ID (D theta_join Budget == Floor C)",
+    ]:
+        expected = parse_input(tokenize(query)).evaluate(assignments)
+        syntax_tree = parse_input(tokenize(query))
+        assert execute(syntax_tree, assignments).tuples == expected.tuples
+        assert bloom_filter_rows_eliminated(syntax_tree) > 0
+
+    syntax_tree = parse_input(tokenize("A join (B join C)"))
+    check_types(syntax_tree, assignments)
+    assert syntax_tree.evaluate(assignments).tuples == expected_chain.tuples
+    assert syntax_tree.rows_eliminated > 0 and syntax_tree.right.rows_eliminated == 0
+
+    syntax_tree = parse_input(tokenize("A join B"))
+    assert execute(syntax_tree, assignments).tuples == natural_join(a, b).tuples
+    assert bloom_filter_rows_eliminated(syntax_tree) == 0
+    assert not contains_join_chain(syntax_tree)
+
+
+def run_memory_tests():
+    a = Relation(("X",), [], (ColumnType(int),))
+    b = Relation(("Y",), [], (ColumnType(int),))
+    for i in range(500):
+        a.tuples.append((IntegerLiteral(i),))
+        b.tuples.append((IntegerLiteral(i),))
+    assignments = {"A": a, "B": b}
+
+    for query in ["A full_join X > Y B", "A theta_join X > Y B", "A join B"]:
+        tracker = QueryTracker(memory_limit=100000)
+        try:
+            execute(parse_input(tokenize(query)), assignments, tracker)
+            assert query == "A join B"
+        except EvaluationException as exception:
+            assert "memory limit" in str(exception)
+        assert tracker.peak_bytes <= 100000
+        assert global_memory.bytes == 0
+
+    tracker = QueryTracker(timeout=0)
+    try:
+        execute(parse_input(tokenize("A full_join X > Y B")), assignments, tracker)
+        assert False
+    except QueryCancelledException:
+        pass
+
+    class CountingTracker(QueryTracker):
+        checks = 0
+
+        def check(self, pending=0):
+            self.checks += 1
+            super().check(pending)
+
+    tracker = CountingTracker()
+    result = execute(
+        parse_input(tokenize("A theta_join X < -1 B")), assignments, tracker
+    )
+    assert len(result.tuples) == 0
+    assert tracker.checks >= 500 * 500 // CHECKPOINT_INTERVAL
+
+    with QueryTracker():
+        table = track(HashTable(), 64)
+        with global_memory.lock:
+            del table
+    assert global_memory.bytes == 0
+
+    tracker = QueryTracker()
+    result = execute(parse_input(tokenize("select X < 10 A")), assignments, tracker)
+    assert len(result.tuples) == 10
+    assert tracker.peak_bytes > 0
+    assert global_memory.bytes == 0
+    assert parse_size("2K") == 2048 and parse_size("1M") == 1 << 20
+
+
+def run_shared_query_tests():
+    e = Relation(("Name", "DeptID", "Age"), [])
+    d = Relation(("DeptID", "Floor"), [])
+    for i in range(300):
+        e.tuples.append(
+            (StringLiteral(f'"e{i}"'), IntegerLiteral(i % 10), IntegerLiteral(i % 60))
+        )
+    for i in range(10):
+        d.tuples.append((IntegerLiteral(i), IntegerLiteral(i % 3)))
+    assignments = {"E": e, "D": d}
+    queries = [
+        "E join D",
+        "select Age > 30 (E join D)",
+        "select Age < 10 E",
+        "project Name (select Age == 7 E)",
+        "(select Age < 10 E) union (select Age > 50 E)",
+    ]
+
+    def parse(query):
+        return parse_input(tokenize(query))
+
+    for compile_queries in [True, False]:
+        sys.modules["main"].COMPILE_QUERIES = compile_queries
+        try:
+            expected = [execute(parse(query), assignments) for query in queries]
+            results, report = execute_queries(
+                [parse(query) for query in queries], assignments
+            )
+        finally:
+            sys.modules["main"].COMPILE_QUERIES = True
+        for a, b in zip(results, expected):
+            assert a.column_names == b.column_names and a.tuples == b.tuples
+        assert (report.scans, report.scans_saved) == (8, 5)
+        assert (report.evaluations, report.evaluations_saved) == (9, 2)
+
+    results, report = execute_queries(
+        [parse("D"), parse("select Floor == 1 D")], assignments
+    )
+    assert results[0] is d and report.scans_saved == 0
+    results, report = execute_queries([parse("1 == 1"), parse("1 == 1")], assignments)
+    assert results == [True, True] and report.evaluations_saved == 0
+
+    queries = ["select Age == 1 E", "select is_null (Age > 1) E"]
+    results, report = execute_queries([parse(query) for query in queries], assignments)
+    for result, query in zip(results, queries):
+        assert result.tuples == execute(parse(query), assignments).tuples
+    assert (report.scans, report.scans_saved) == (2, 1)
+
+    try:
+        execute_queries([parse("insert into D { 1, 2 }")], assignments)
+        assert False
+    except EvaluationException:
+        pass
+
+
 run_operator_tests()
+run_compiler_tests()
+run_type_check_tests()
+run_order_tests()
+run_catalog_tests()
+run_statement_tests()
+run_bloom_filter_tests()
+run_memory_tests()
+run_server_tests()
+run_batch_tests()
+run_shared_query_tests()
 print("All tests passed")